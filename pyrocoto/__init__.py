@@ -1 +1,5 @@
 from .pyrocoto import *
+from .cycles import *
+from .simulate import *
+from .loader import *
+from .shards import *
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+''' pyrocoto command line
+
+    pyrocoto build module:flow -o out.xml
+    pyrocoto build suites/*.py -o xml/ -j 4
+'''
+import argparse
+import hashlib
+import importlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import sysconfig
+from concurrent.futures import ProcessPoolExecutor
+from itertools import count
+from .pyrocoto import Workflow, workflow_namespace, clear_namespace
+
+_stamp_format = 1
+_target_ids = count()  # python files are imported as _pyrocoto_target_<id>
+# modules from these are kept imported between builds, extension modules can not be reloaded
+_installed = tuple({os.path.join(sysconfig.get_path(name), '')
+                    for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')})
+
+
+class Target:
+    ''' A workflow to build: module[:attribute][=output]
+        module is a module name or the path of a python file. attribute, default flow, is
+        the Workflow or a function returning it. output defaults to the module's name
+        with .xml in the output directory.'''
+    def __init__(self, spec, outdir='.'):
+        self.spec = spec
+        target, sep, output = spec.partition('=')
+        module, _, attribute = target.partition(':')
+        if not module or sep and not output:
+            raise ValueError(f'Expected module[:attribute][=output] but got {spec!r}')
+        self.module = module
+        self.attribute = attribute or 'flow'
+        if not output:
+            if module.endswith('.py'):
+                stem = os.path.splitext(os.path.basename(module))[0]
+            else:
+                stem = module.rpartition('.')[2]
+            output = os.path.join(outdir, f'{stem}.xml')
+        self.output = os.path.expanduser(output)
+
+    def __repr__(self):
+        return f'Target({self.spec!r})'
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+
+def _stamp_path(output):
+    return f'{output}.build.json'
+
+
+def _options(target, inputs, ordered):
+    return {'format': _stamp_format, 'module': target.module, 'attribute': target.attribute,
+            'inputs': sorted(inputs), 'ordered': ordered}
+
+
+def up_to_date(target, inputs=(), ordered=False):
+    ''' Return whether target's output was built from the files it used as they are now
+        Files with a different mtime or size are compared by their content hash.'''
+    try:
+        with open(_stamp_path(target.output)) as f:
+            stamp = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    if stamp.get('options') != _options(target, inputs, ordered):
+        return False
+    if not os.path.exists(target.output):
+        return False
+    for path, (mtime, size, digest) in stamp['files'].items():
+        try:
+            st = os.stat(path)
+            if (st.st_mtime_ns, st.st_size) != (mtime, size) and _file_digest(path) != digest:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def _import(module):
+    if not module.endswith('.py'):
+        return importlib.import_module(module)
+    # under a name of its own, a file named as another module, json.py, does not replace it
+    name = f'_pyrocoto_target_{next(_target_ids)}'
+    spec = importlib.util.spec_from_file_location(name, module)
+    if spec is None:
+        raise ImportError(f'Can not import {module!r}')
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[name] = mod
+    # as when run as a script, modules next to it can be imported
+    sys.path.insert(0, os.path.dirname(os.path.abspath(module)))
+    try:
+        spec.loader.exec_module(mod)
+    finally:
+        del sys.path[0]
+    return mod
+
+
+def build(target, inputs=(), ordered=False):
+    ''' Import target's module and write its workflow to target.output incrementally
+        The module is imported in a workflow namespace of its own and the modules imported,
+        other than installed ones, are forgotten afterwards so targets are built
+        independently in one process.
+        Return the diff of write_xml.'''
+    modules = set(sys.modules)
+    namespace = f'pyrocoto build {target.output}'
+    try:
+        with workflow_namespace(namespace):
+            flow = getattr(_import(target.module), target.attribute)
+            if not isinstance(flow, Workflow) and callable(flow):
+                flow = flow()
+        if not isinstance(flow, Workflow):
+            raise TypeError(f'Expected {target.module}:{target.attribute} to be a Workflow '
+                            f'or function returning one, but got {type(flow)}')
+        if flow._builders:
+            flow.build()
+        os.makedirs(os.path.dirname(os.path.abspath(target.output)), exist_ok=True)
+        diff = flow.write_xml(target.output, ordered=ordered, incremental=True)
+        files = [getattr(sys.modules[name], '__file__', None)
+                 for name in sys.modules.keys() - modules]
+        files += [os.path.join(os.path.dirname(__file__), name)
+                  for name in os.listdir(os.path.dirname(__file__)) if name.endswith('.py')]
+        files += list(inputs)
+        stamp = {'options': _options(target, inputs, ordered), 'files': {}}
+        for path in sorted({os.path.abspath(path) for path in files
+                            if path and os.path.exists(path)}):
+            st = os.stat(path)
+            stamp['files'][path] = [st.st_mtime_ns, st.st_size, _file_digest(path)]
+        with open(_stamp_path(target.output), 'w') as f:
+            json.dump(stamp, f)
+        return diff
+    finally:
+        clear_namespace(namespace)
+        for name in sys.modules.keys() - modules:
+            path = getattr(sys.modules[name], '__file__', None)
+            if not path or not os.path.abspath(path).startswith(_installed):
+                del sys.modules[name]
+
+
+def _build(target, inputs, ordered):
+    ''' build target returning (diff, None), or (None, error message) '''
+    try:
+        return build(target, inputs, ordered), None
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='pyrocoto', description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_build = commands.add_parser(
+        'build', help='write the xml of workflows defined in python modules',
+        description='Write the xml of workflows defined in python modules. Outputs built '
+                    'from files that have not changed since are skipped.')
+    parser_build.add_argument('targets', nargs='+', metavar='module[:flow][=output]',
+                              help='module name or python file and the name of its '
+                                   'Workflow, default flow')
+    parser_build.add_argument('-o', '--output',
+                              help='output file of a single target, or directory of the '
+                                   'outputs')
+    parser_build.add_argument('-i', '--input', action='append', default=[],
+                              help='file read by the modules; changes cause a rebuild')
+    parser_build.add_argument('-j', '--jobs', type=int, default=1,
+                              help='number of processes building targets')
+    parser_build.add_argument('-f', '--force', action='store_true',
+                              help='build targets that are up to date')
+    parser_build.add_argument('--ordered', action='store_true',
+                              help='write tasks in dependency order')
+    return parser
+
+
+def _targets(args):
+    output = args.output
+    if output is not None and (len(args.targets) > 1 or os.path.isdir(output) or
+                               output.endswith(os.sep)):
+        targets = [Target(spec, output) for spec in args.targets]
+    else:
+        targets = [Target(spec) for spec in args.targets]
+        if output is not None:
+            targets[0].output = os.path.expanduser(output)
+    outputs = [os.path.abspath(target.output) for target in targets]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError('Expected each target to write a different output')
+    return targets
+
+
+def main(argv=None):
+    ''' run the pyrocoto command line; return exit status '''
+    parser = _parser()
+    args = parser.parse_args(argv)
+    try:
+        targets = _targets(args)
+    except ValueError as e:
+        parser.error(str(e))
+    inputs = [os.path.abspath(os.path.expanduser(path)) for path in args.input]
+    # target modules are imported relative to the current directory, as with python -m
+    if '' not in sys.path and os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    todo = [target for target in targets
+            if args.force or not up_to_date(target, inputs, args.ordered)]
+    for target in targets:
+        if target not in todo:
+            print(f'{target.output}: up to date')
+    if args.jobs > 1 and len(todo) > 1:
+        # forked workers share what is imported here
+        fork = 'fork' in multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork') if fork else None
+        with ProcessPoolExecutor(min(args.jobs, len(todo)), mp_context=context) as pool:
+            results = list(pool.map(_build, todo, [inputs] * len(todo),
+                                    [args.ordered] * len(todo)))
+    else:
+        results = [_build(target, inputs, args.ordered) for target in todo]
+    status = 0
+    for target, (diff, error) in zip(todo, results):
+        if error is not None:
+            print(f'{target.spec}: {error}', file=sys.stderr)
+            status = 1
+        elif diff['written']:
+            print(f"{target.output}: {len(diff['added'])} added, "
+                  f"{len(diff['changed'])} changed, {len(diff['removed'])} removed")
+        else:
+            print(f'{target.output}: unchanged')
+    return status
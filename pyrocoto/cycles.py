@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+''' Parse rocoto cycle definitions and enumerate the cycle times they define.
+    Enumerating cycles requires numpy; cycle times are numpy datetime64[m] arrays.'''
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed to enumerate cycles
+    np = None
+
+__all__ = ['CronDefinition', 'IntervalDefinition', 'parse_definition', 'expand_cycles',
+           'expand_cyclestr']
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError('numpy is required to expand cycles; install pyrocoto[cycles]')
+
+
+def _offset_seconds(offset):
+    ''' convert a rocoto time offset, [-]dd:hh:mm:ss with leading fields optional,
+        to seconds '''
+    sign = -1 if offset.startswith('-') else 1
+    fields = offset.lstrip('+-').split(':')
+    if len(fields) > 4:
+        raise ValueError(f'Expected offset {offset!r} to be of form [-]dd:hh:mm:ss')
+    seconds = 0
+    for field, size in zip(reversed(fields), (1, 60, 3600, 86400)):
+        seconds += int(field) * size
+    return sign * seconds
+
+
+def _parse_field(field, name, low, high):
+    ''' return sorted tuple of values allowed by a cron field, None for "*" '''
+    if field == '*':
+        return None
+    values = set()
+    for part in field.split(','):
+        spec, _, step = part.partition('/')
+        try:
+            step = int(step) if step else 1
+            if spec == '*':
+                first, last = low, high
+            elif '-' in spec:
+                first, last = (int(x) for x in spec.split('-'))
+            else:
+                first = last = int(spec)
+        except ValueError:
+            raise ValueError(f'Expected cron {name} field {field!r} to contain '
+                             'numbers, ranges, steps or "*"') from None
+        if step < 1 or not low <= first <= last <= high:
+            raise ValueError(f'Expected cron {name} field {field!r} to be within '
+                             f'{low}-{high}')
+        values.update(range(first, last + 1, step))
+    return tuple(sorted(values))
+
+
+def _to_minute(value):
+    ''' convert datetime, numpy datetime64 or string YYYYMMDDhhmm to datetime64[m] '''
+    _require_numpy()
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y%m%d%H%M')
+    return np.datetime64(value, 'm')
+
+
+class CronDefinition:
+    ''' cycle definition of form "minute hour day month year weekday"
+        Each field holds values, ranges (a-b) and steps (*/n or a-b/n) separated by commas,
+        or "*" for every value. A cycle must match all fields. Weekdays are 0-6 from Sunday.'''
+    fields = (('minute', 0, 59),
+              ('hour', 0, 23),
+              ('day', 1, 31),
+              ('month', 1, 12),
+              ('year', 1900, 9999),
+              ('weekday', 0, 6))
+
+    def __init__(self, definition):
+        parts = definition.split()
+        if len(parts) != len(self.fields):
+            raise ValueError(f'Expected cron definition {definition!r} to have 6 fields')
+        for part, (name, low, high) in zip(parts, self.fields):
+            setattr(self, name, _parse_field(part, name, low, high))
+
+    def __repr__(self):
+        return "CronDefinition({!r})".format(self.__dict__)
+
+    def cycles(self, start, end):
+        ''' return datetime64[m] array of cycle times from start to end inclusive '''
+        start, end = _to_minute(start), _to_minute(end)
+        days = np.arange(start.astype('M8[D]'), end.astype('M8[D]') + 1)
+        keep = np.ones(days.shape, dtype=bool)
+        months = days.astype('M8[M]')
+        if self.year is not None:
+            years = months.astype('M8[Y]').astype(np.int64) + 1970
+            keep &= np.isin(years, self.year)
+        if self.month is not None:
+            keep &= np.isin(months.astype(np.int64) % 12 + 1, self.month)
+        if self.day is not None:
+            keep &= np.isin((days - months).astype(np.int64) + 1, self.day)
+        if self.weekday is not None:
+            # 1970-01-01 was a Thursday
+            keep &= np.isin((days.astype(np.int64) + 4) % 7, self.weekday)
+        hours = np.arange(24) if self.hour is None else np.array(self.hour)
+        minutes = np.arange(60) if self.minute is None else np.array(self.minute)
+        time_of_day = (hours[:, None] * 60 + minutes[None, :]).ravel().astype('m8[m]')
+        cycles = (days[keep].astype('M8[m]')[:, None] + time_of_day[None, :]).ravel()
+        return cycles[(cycles >= start) & (cycles <= end)]
+
+
+class IntervalDefinition:
+    ''' cycle definition of form "start end interval"
+        start and end are YYYYMMDDhhmm and interval is [dd:]hh:mm:ss '''
+    def __init__(self, definition):
+        parts = definition.split()
+        if len(parts) != 3:
+            raise ValueError(f'Expected interval definition {definition!r} to have 3 fields')
+        try:
+            self.start, self.end = (datetime.strptime(p, '%Y%m%d%H%M') for p in parts[:2])
+            self.interval = _offset_seconds(parts[2])
+        except ValueError:
+            raise ValueError(f'Expected interval definition {definition!r} to be of form '
+                             '"YYYYMMDDhhmm YYYYMMDDhhmm dd:hh:mm:ss"') from None
+        if self.interval <= 0 or self.interval % 60:
+            raise ValueError(f'Expected interval in {definition!r} to be a positive '
+                             'number of minutes')
+        if self.end < self.start:
+            raise ValueError(f'Expected start before end in interval definition {definition!r}')
+
+    def __repr__(self):
+        return "IntervalDefinition({!r})".format(self.__dict__)
+
+    def cycles(self, start, end):
+        ''' return datetime64[m] array of cycle times from start to end inclusive '''
+        start, end = _to_minute(start), _to_minute(end)
+        first, last = _to_minute(self.start), _to_minute(self.end)
+        step = np.timedelta64(self.interval // 60, 'm')
+        # first and last multiples of the interval within the requested range
+        if start > first:
+            first += -((first - start) // step) * step
+        last = min(last, end)
+        if last < first:
+            return np.array([], dtype='M8[m]')
+        return np.arange(first, last + step, step)[:(last - first) // step + 1]
+
+
+def parse_definition(definition):
+    ''' return a CronDefinition or IntervalDefinition from a rocoto cycledef definition
+        A ValueError is raised if the definition is not valid '''
+    if len(definition.split()) == 3:
+        return IntervalDefinition(definition)
+    return CronDefinition(definition)
+
+
+def expand_cycles(cycledefs, start, end):
+    ''' Return dict of group name to datetime64[m] array of cycle times from start to end
+        inclusive. cycledefs is a CycleDefinition, a list of them, or a dict such as
+        Workflow.cycle_definitions. start and end are datetime, datetime64 or YYYYMMDDhhmm.
+        Cycle times of several groups can be combined with numpy.union1d.'''
+    if isinstance(cycledefs, dict):
+        cycledefs = cycledefs.values()
+    elif not isinstance(cycledefs, (list, tuple)):
+        cycledefs = [cycledefs]
+    return {cycledef.group: cycledef.cycles(start, end) for cycledef in cycledefs}
+
+
+_weekdays = ('Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday')
+_months = ('January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+           'September', 'October', 'November', 'December')
+
+# cyclestr flags and how they format a datetime
+_cyclestr_flags = {
+    'Y': lambda t: f'{t.year:04d}',
+    'y': lambda t: f'{t.year % 100:02d}',
+    'm': lambda t: f'{t.month:02d}',
+    'd': lambda t: f'{t.day:02d}',
+    'H': lambda t: f'{t.hour:02d}',
+    'M': lambda t: f'{t.minute:02d}',
+    'S': lambda t: f'{t.second:02d}',
+    'j': lambda t: f'{t.timetuple().tm_yday:03d}',
+    's': lambda t: str(int((t - datetime(1970, 1, 1)).total_seconds())),
+    'a': lambda t: _weekdays[(t.weekday() + 1) % 7][:3],
+    'A': lambda t: _weekdays[(t.weekday() + 1) % 7],
+    'b': lambda t: _months[t.month - 1][:3],
+    'B': lambda t: _months[t.month - 1],
+}
+_cyclestr_re = re.compile('@([{}])'.format(''.join(_cyclestr_flags)))
+
+
+@lru_cache(maxsize=4096)
+def _compile_cyclestr(template):
+    ''' return tuple of the parts of a cyclestr template; odd parts are flags '''
+    return tuple(_cyclestr_re.split(template))
+
+
+def _cyclestr_values(times, flags):
+    ''' return dict of cyclestr flag to int array of its value for a datetime64[s] array;
+        names of weekdays and months are given by their index '''
+    days = times.astype('M8[D]')
+    months = times.astype('M8[M]')
+    years = months.astype('M8[Y]')
+    values = {
+        'Y': lambda: years.astype(np.int64) + 1970,
+        'y': lambda: (years.astype(np.int64) + 1970) % 100,
+        'm': lambda: months.astype(np.int64) % 12 + 1,
+        'd': lambda: (days - months.astype('M8[D]')).astype(np.int64) + 1,
+        'H': lambda: (times - days) // np.timedelta64(1, 'h'),
+        'M': lambda: (times - days) // np.timedelta64(1, 'm') % 60,
+        'S': lambda: (times - days) // np.timedelta64(1, 's') % 60,
+        'j': lambda: (days - years.astype('M8[D]')).astype(np.int64) + 1,
+        's': lambda: times.astype(np.int64),
+        'a': lambda: (days.astype(np.int64) + 4) % 7,  # 1970-01-01 was a Thursday
+        'b': lambda: months.astype(np.int64) % 12,
+    }
+    values['A'] = values['a']
+    values['B'] = values['b']
+    return {flag: np.asarray(values[flag]()) for flag in flags}
+
+
+# width of flags that always format to the same number of characters
+_fixed_width = {'Y': 4, 'y': 2, 'm': 2, 'd': 2, 'H': 2, 'M': 2, 'S': 2, 'j': 3, 'a': 3, 'b': 3}
+_names = {'a': [w[:3] for w in _weekdays], 'A': _weekdays,
+          'b': [m[:3] for m in _months], 'B': _months}
+
+
+def _format_fixed(parts, values, n):
+    ''' format parts of a template with only fixed width flags and ascii text by writing
+        characters into a byte array with one row per time '''
+    width = sum(len(p) if ix % 2 == 0 else _fixed_width[p] for ix, p in enumerate(parts))
+    if width == 0:
+        return np.full(n, '')
+    chars = np.empty((n, width), dtype=np.uint8)
+    col = 0
+    for ix, part in enumerate(parts):
+        if ix % 2 == 0:
+            chars[:, col:col + len(part)] = np.frombuffer(part.encode('ascii'), np.uint8)
+            col += len(part)
+            continue
+        size = _fixed_width[part]
+        if part in _names:
+            table = np.array([list(name.encode('ascii')) for name in _names[part]], np.uint8)
+            chars[:, col:col + size] = table[values[part]]
+        else:
+            value = values[part]
+            for digit in range(size):
+                chars[:, col + size - 1 - digit] = 48 + value // 10**digit % 10
+        col += size
+    return chars.view(f'S{width}').ravel().astype(f'U{width}')
+
+
+def _format_general(parts, values, n):
+    ''' format parts of a template by concatenating string arrays '''
+    result = np.full(n, parts[0], dtype=f'U{max(len(parts[0]), 1)}')
+    for ix, part in enumerate(parts[1:]):
+        if ix % 2:
+            result = np.char.add(result, part)
+        elif part in _names:
+            result = np.char.add(result, np.array(_names[part])[values[part]])
+        else:
+            text = values[part].astype(str)
+            if part in _fixed_width:
+                text = np.char.zfill(text, _fixed_width[part])
+            result = np.char.add(result, text)
+    return result
+
+
+def expand_cyclestr(template, cycle, offset=None):
+    ''' Return what a cyclestr template such as "/com/@Y@m@d/@H" becomes for cycle time(s).
+        template may be an Offset, whose offset is then applied. offset is a rocoto offset
+        such as "-06:00:00" added to the cycle time before formatting.
+        cycle may be a datetime or string YYYYMMDDhhmm, giving a string, or a numpy datetime64
+        array such as returned by CycleDefinition.cycles, giving a numpy array of strings.
+        Compiled templates are cached by template string.'''
+    if hasattr(template, 'offset') and hasattr(template, 'value'):  # Offset
+        if offset is not None:
+            raise ValueError('offset given for template that is an Offset')
+        template, offset = template.value, template.offset
+    parts = _compile_cyclestr(template)
+    seconds = 0 if offset is None else _offset_seconds(offset)
+    if np is not None and isinstance(cycle, np.ndarray):
+        times = cycle.astype('M8[s]').ravel() + np.timedelta64(seconds, 's')
+        flags = set(parts[1::2])
+        values = _cyclestr_values(times, flags)
+        if flags.issubset(_fixed_width) and template.isascii():
+            result = _format_fixed(parts, values, len(times))
+        else:
+            result = _format_general(parts, values, len(times))
+        return result.reshape(cycle.shape)
+    if isinstance(cycle, str):
+        cycle = datetime.strptime(cycle, '%Y%m%d%H%M')
+    elif np is not None and isinstance(cycle, np.datetime64):
+        cycle = cycle.astype('M8[s]').astype(datetime)
+    time = cycle + timedelta(seconds=seconds)
+    return ''.join(_cyclestr_flags[part](time) if ix % 2 else part
+                   for ix, part in enumerate(parts))
@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 from abc import ABC, abstractmethod
+from contextvars import ContextVar
+from functools import lru_cache
+from threading import Lock
 
 
 class Validator(ABC):
@@ -18,11 +21,11 @@ class Validator(ABC):
         v = self.validate(value)
         if v is not None:
             value = v
+        # validated data is tracked by the presence of the private attribute, see validated
         setattr(obj, self.private_name, value)
-        if not hasattr(obj, '_validated'):
-            obj._validated = []
-        if self.private_name not in obj._validated:
-            obj._validated.append(self.private_name)
+        # objects that cache output generated from validated data drop it on change
+        if getattr(obj, '_xml_cache', None) is not None:
+            obj._xml_cache = None
 
     @abstractmethod
     def validate(self, value):
@@ -31,8 +34,30 @@ class Validator(ABC):
         pass
 
 
+def validated(obj):
+    ''' return set of the private names of obj's validated attributes that are set '''
+    return {name for name in _private_names(type(obj)) if hasattr(obj, name)}
+
+
+@lru_cache(maxsize=None)
+def _private_names(cls):
+    ''' return the private names of the validated attributes of class cls '''
+    return tuple({v.private_name: None for c in cls.__mro__ for v in vars(c).values()
+                  if isinstance(v, Validator)})
+
+
 class Borg:
+    ''' instances share the state of their namespace, the default namespace None shares
+        _shared_state; the namespace of the context is used when namespace is None '''
     _shared_state = {}
-
-    def __init__(self):
-        self.__dict__ = self._shared_state
+    _namespaces = {}  # namespace -> shared state
+    _namespace = ContextVar('namespace', default=None)
+    _init_lock = Lock()  # held by subclasses while initializing the shared state
+
+    def __init__(self, namespace=None):
+        if namespace is None:
+            namespace = self._namespace.get()
+        if namespace is None:
+            self.__dict__ = self._shared_state
+        else:
+            self.__dict__ = self._namespaces.setdefault(namespace, {})
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+''' Load existing rocoto workflow xml into a Workflow '''
+import os
+from xml.etree.ElementTree import Element, TreeBuilder
+from xml.parsers import expat
+from .pyrocoto import (Workflow, Task, Offset, Dependency, DataDep, TaskDep, MetaTaskDep,
+                       TimeDep)
+
+__all__ = ['read_xml']
+
+_operators = ('and', 'or', 'not', 'nand', 'nor', 'xor', 'some')
+_task_attributes = ('name', 'cycledefs', 'maxtries', 'final')
+# task elements holding text, the String attributes of Task
+_task_text = ('jobname', 'command', 'join', 'stderr', 'stdout', 'account', 'queue',
+              'partition', 'walltime', 'cores', 'nodes', 'native', 'memory', 'nodesize')
+
+
+def _unsupported(what, name):
+    return ValueError(f'{what} is not supported; in {name!r}')
+
+
+def _text_value(E, name):
+    ''' return the text of element E as a string, or Offset when its cyclestr has an offset
+        Text outside of cyclestr elements holding no '@' is joined with the cyclestr text.'''
+    if len(E) == 0:
+        return E.text or ''
+    for child in E:
+        if child.tag != 'cyclestr' or not set(child.attrib) <= {'offset'}:
+            raise _unsupported(f'<{child.tag}> in <{E.tag}>', name)
+    offsets = {child.get('offset') for child in E}
+    if len(offsets) > 1:
+        raise _unsupported(f'cyclestr elements with different offsets in <{E.tag}>', name)
+    plain = [E.text] + [child.tail for child in E]
+    if all(not text or text.isspace() for text in plain):
+        # layout of pretty printed xml
+        text = ''.join(child.text or '' for child in E)
+    elif any('@' in text for text in plain if text):
+        raise _unsupported(f"'@' outside of cyclestr in <{E.tag}>", name)
+    else:
+        text = (E.text or '') + ''.join((child.text or '') + (child.tail or '') for child in E)
+    offset = offsets.pop()
+    return text if offset is None else Offset(text, offset)
+
+
+def _strip_layout(E):
+    ''' remove the whitespace text of pretty printed xml from elements with children '''
+    for elem in E.iter():
+        if len(elem) and elem.text and elem.text.isspace():
+            elem.text = None
+        if elem.tail and elem.tail.isspace():
+            elem.tail = None
+    return E
+
+
+def _dependency(E, name):
+    ''' return Dependency made from dependency element E '''
+    attrib = set(E.attrib)
+    if E.tag in _operators:
+        elm = Element(E.tag, E.attrib)
+        elm.extend(_dependency(child, name).elm for child in E)
+        return Dependency(elm)
+    if E.tag == 'taskdep' and attrib <= {'task', 'cycle_offset', 'state'}:
+        return TaskDep(**E.attrib)
+    if E.tag == 'metataskdep' and attrib <= {'metatask', 'cycle_offset', 'state', 'threshold'}:
+        return MetaTaskDep(**E.attrib)
+    if E.tag == 'datadep' and attrib <= {'age', 'minsize'}:
+        return DataDep(_text_value(E, name), **E.attrib)
+    if E.tag == 'timedep' and not attrib:
+        return TimeDep(_text_value(E, name))
+    # other conditions (sh, rb, ...) are kept as elements
+    return Dependency(_strip_layout(E))
+
+
+def _task(E, flow):
+    ''' return Task made from task or metatask element E '''
+    levels = []
+    metatask_name = None
+    while E.tag == 'metatask':
+        name = E.get('name', '')
+        if not set(E.attrib) <= {'name'}:
+            raise _unsupported(f'metatask attributes {sorted(set(E.attrib) - {"name"})}',
+                               name)
+        if levels and 'name' in E.attrib:
+            raise _unsupported('name of a nested metatask', name)
+        children = [child for child in E if child.tag != 'var']
+        if len(children) != 1:
+            raise _unsupported('metatask not holding exactly one task or metatask', name)
+        levels.append({var.get('name'): (var.text or '').strip()
+                       for var in E if var.tag == 'var'})
+        if metatask_name is None:
+            metatask_name = E.get('name')
+        E = children[0]
+    name = E.get('name', '')
+    if E.tag != 'task':
+        raise _unsupported(f'<{E.tag}> in metatask', name)
+    if not set(E.attrib) <= set(_task_attributes):
+        raise _unsupported(f'task attributes {sorted(set(E.attrib) - set(_task_attributes))}',
+                           name)
+    d = dict(E.attrib)
+    # tasks without cycledefs run for every cycle definition
+    d['cycledefs'] = (E.get('cycledefs').split(',') if 'cycledefs' in E.attrib
+                      else list(flow.cycle_definitions))
+    for child in E:
+        if child.tag in _task_text:
+            d[child.tag] = _text_value(child, name)
+        elif child.tag == 'envar':
+            value = child.find('value')
+            if child.find('name') is None or value is None:
+                raise ValueError(f'envar without name or value in {name!r}')
+            d.setdefault('envar', {})[child.findtext('name')] = _text_value(value, name)
+        elif child.tag == 'dependency':
+            if len(child) != 1:
+                raise ValueError(f'dependency without exactly one condition in {name!r}')
+            d['dependency'] = _dependency(child[0], name)
+        else:
+            raise _unsupported(f'<{child.tag}>', name)
+    if levels:
+        d['meta'] = levels[0] if len(levels) == 1 else levels
+        if metatask_name is not None:
+            d['metatask_name'] = metatask_name
+    return Task(d)
+
+
+class _Reader:
+    ''' expat handlers building the workflow's elements, each child of the workflow is
+        loaded and discarded once complete so only one task is held as elements at a time '''
+    def __init__(self, flow):
+        self.flow = flow
+        self.depth = 0
+        self.builder = TreeBuilder()
+        self.root = None
+        self.tasks = []
+        self.errors = []
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        E = self.builder.start(tag, attrib)
+        if self.depth == 1:
+            if tag != 'workflow':
+                raise ValueError(f'Expected workflow element but found <{tag}>')
+            if self.flow is None:
+                self.flow = Workflow(_shared=False, **attrib)
+            else:
+                self.flow.workflow_element.attrib.update(attrib)
+            self.root = E
+
+    def end(self, tag):
+        self.depth -= 1
+        E = self.builder.end(tag)
+        if self.depth == 1:
+            self.root.clear()
+            try:
+                self.load(E)
+            except (ValueError, TypeError) as e:
+                self.errors.append(f'<{E.tag} name={E.get("name")!r}>: {e}')
+
+    def load(self, E):
+        flow = self.flow
+        if E.tag == 'log':
+            if len(E) == 0 or len(E) == 1 and not set(E[0].attrib):
+                flow.set_log(_text_value(E, 'log'))
+            else:
+                flow.log_element = _strip_layout(E)
+        elif E.tag == 'cycledef':
+            flow.define_cycle(E.get('group'), (E.text or '').strip(),
+                              E.get('activation_offset'))
+        elif E.tag in ('task', 'metatask'):
+            self.tasks.append(_task(E, flow))
+        else:
+            raise _unsupported(f'<{E.tag}>', 'workflow')
+
+    def external_entity(self, context, base, system_id, public_id):
+        ''' parse SYSTEM entities, files relative to the including file '''
+        including = self.parser
+        self.parser = parser = including.ExternalEntityParserCreate(context)
+        path = os.path.join(base or '', system_id)
+        parser.SetBase(os.path.dirname(os.path.abspath(path)))
+        try:
+            with open(path, 'rb') as f:
+                parser.ParseFile(f)
+        finally:
+            self.parser = including
+        return 1
+
+    def parse(self, f, base):
+        self.parser = parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+        parser.SetBase(base)
+        parser.StartElementHandler = self.start
+        parser.EndElementHandler = self.end
+        parser.CharacterDataHandler = self.builder.data
+        parser.ExternalEntityRefHandler = self.external_entity
+        parser.ParseFile(f)
+
+
+def read_xml(xmlfile, flow=None):
+    ''' Return Workflow loaded from rocoto workflow xml
+        xmlfile may be a path or a binary file-like object; the file is parsed as a stream
+        and its ENTITYs, including SYSTEM entities, are resolved. Cycle definitions, the
+        log and tasks, including metatasks and nested metatasks, their envars and
+        dependencies are loaded into flow, or a new independent Workflow.
+        Every problem found is reported in a single ValueError.'''
+    reader = _Reader(flow)
+    if hasattr(xmlfile, 'read'):
+        reader.parse(xmlfile, os.getcwd())
+    else:
+        xmlfile = os.path.expanduser(xmlfile)
+        with open(xmlfile, 'rb') as f:
+            reader.parse(f, os.path.dirname(os.path.abspath(xmlfile)))
+    errors = reader.errors
+    if not errors:
+        try:
+            reader.flow.add_tasks(reader.tasks)
+        except ValueError as e:
+            errors = [str(e)]
+    if errors:
+        raise ValueError(f'Errors loading {getattr(xmlfile, "name", xmlfile)}:\n' +
+                         '\n'.join(errors))
+    return reader.flow
@@ -1,9 +1,22 @@
 #!/usr/bin/env python
-from xml.etree.ElementTree import Element, tostring
-from xml.dom import minidom
-from .helpers import Validator, Borg
-from itertools import product
+from xml.etree.ElementTree import Element, SubElement, tostring
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from threading import RLock
+from collections import Counter
+from .helpers import Validator, Borg, validated
+from .cycles import parse_definition, _offset_seconds
+from itertools import chain, count, product, repeat, starmap
+from functools import lru_cache
+from contextlib import contextmanager
+from math import prod
+import hashlib
+import inspect
+import json
+import multiprocessing
 import logging
+import os
+import pickle
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -16,13 +29,13 @@ class String(Validator):
     def validate(self, value):
         if isinstance(value, Offset):
             return  # offset objects are strings with additional offset
-        name = super().get_name()
         if not isinstance(value, str):
-            raise TypeError(f'Expected "{name}" value {value!r} to be a string')
+            raise TypeError(f'Expected "{self.get_name()}" value {value!r} to be a string')
 
         if self.isin is not None:
             if self.isin not in value:
-                raise ValueError(f'Expected {self.isin} in "{name}" value {repr(value)}')
+                raise ValueError(f'Expected {self.isin} in "{self.get_name()}" value '
+                                 f'{repr(value)}')
 
         if self.one_of is not None:
             if value not in self.one_of:
@@ -51,24 +64,19 @@ class Envar(Validator):
         self.isin = contains
 
     def validate(self, value):
-        ''' stores xml from dict input '''
+        ''' stores an interned tuple of (name, text, cyclestr) for each entry of dict input;
+            the xml is made by _envar_element when the task's xml is generated '''
         if not isinstance(value, dict):
             raise TypeError(f'Expected envar value {value!r} to be a dictionary')
         envars = []
         for name, v in value.items():
-            envar = Element('envar')
-            name_element = Element('name')
-            name_element.text = name
-            envar.append(name_element)
-            if isinstance(v, str):
-                value_element = Element('value')
-                value_element.text = v
-                value_element = _cyclestr(value_element)
+            if isinstance(v, Offset):
+                envars.append((name, v.value, (('offset', v.offset),)))
+            elif isinstance(v, str):
+                envars.append((name, v, () if '@' in v else None))
             else:
-                value_element = to_element(v, 'value')
-            envar.append(value_element)
-            envars.append(envar)
-        return envars
+                raise TypeError(f'Expected envar {name!r} value {v!r} to be a string or Offset')
+        return _intern(tuple(envars))
 
 
 class Meta(Validator):
@@ -76,12 +84,51 @@ class Meta(Validator):
         self.isin = contains
 
     def validate(self, value):
-        if not isinstance(value, dict):
-            raise TypeError(f'Expected meta value {value!r} to be a dictionary')
-        for v in value.values():
-            if not isinstance(v, str):
-                raise TypeError(f'Expected to find string values in meta dict, \
-                                  but found {repr(v)}')
+        ''' a dict, or a list of dicts for nested metatasks from outermost to innermost '''
+        levels = value if isinstance(value, list) else [value]
+        if not levels:
+            raise ValueError('Expected meta list to have dictionaries')
+        keys = set()
+        for level in levels:
+            if not isinstance(level, dict):
+                raise TypeError(f'Expected meta value {value!r} to be a dictionary '
+                                'or list of dictionaries')
+            if not level:
+                raise ValueError('Expected meta dictionary to have variables')
+            for k, v in level.items():
+                if not isinstance(v, str):
+                    raise TypeError(f'Expected to find string values in meta dict, \
+                                      but found {repr(v)}')
+                if k in keys:
+                    raise ValueError(f'meta variable {k!r} is repeated in nested metatask')
+                keys.add(k)
+
+
+@lru_cache(maxsize=2**16)
+def _intern(spec):
+    ''' return the first seen of the recently seen specs equal to spec, so equal specs
+        are shared '''
+    return spec
+
+
+def _leaf_element(tag, attrs=(), text=None, cyclestr=None):
+    ''' return new element tag with attributes attrs, a tuple of (name, value), holding text
+        The text is wrapped in a cyclestr element with attributes cyclestr unless
+        cyclestr is None.'''
+    E = Element(tag, dict(attrs))
+    if cyclestr is None:
+        E.text = text
+    else:
+        SubElement(E, 'cyclestr', dict(cyclestr)).text = text
+    return E
+
+
+def _envar_element(name, text, cyclestr):
+    ''' return new envar element for an entry of Envar '''
+    E = Element('envar')
+    E.append(_leaf_element('name', (), name))
+    E.append(_leaf_element('value', (), text, cyclestr))
+    return E
 
 
 class XmlElement(Validator):
@@ -94,11 +141,16 @@ class XmlElement(Validator):
 
 
 class Dependency():
+    ''' dependency xml element with the task and metatask dependencies it references
+        refs is a tuple of (tag, name, cycle_offset) for each taskdep and metataskdep'''
 
     elm = XmlElement()
 
-    def __init__(self, elm):
+    def __init__(self, elm, refs=None):
         self.elm = elm
+        if refs is None:
+            refs = tuple(_dependency_refs(elm))
+        self.refs = refs
 
     @staticmethod
     def operator(oper, *args):
@@ -108,17 +160,68 @@ class Dependency():
         for arg in args:
             if not isinstance(arg, Dependency):
                 raise TypeError(f'Expected Dependency but got {type(arg)},{arg}')
-        elm = Element(oper)
-        for arg in args:
-            elm.append(arg.elm)
-        return Dependency(elm)
+        return _OperatorDep(oper, args)
+
+    def simplify(self):
+        ''' Return an equivalent dependency with nested and/or operators flattened,
+            duplicate operands removed and single operand and/or and double not removed'''
+        elm = _simplify(self.elm)
+        return self if elm is self.elm else Dependency(elm)
 
     def to_element(self, name='dependency'):
         E = Element(name)
-        E.append(self.elm)
+        E.append(_simplify(self.elm))
         return E
 
 
+_ref_attr = {'taskdep': 'task', 'metataskdep': 'metatask'}
+
+
+def _dependency_refs(elm):
+    ''' yield (tag, name, cycle_offset) for the taskdep and metataskdep elements in elm '''
+    for E in elm.iter():
+        if E.tag in _ref_attr:
+            yield (E.tag, E.attrib[_ref_attr[E.tag]], E.attrib.get('cycle_offset'))
+
+
+def _element_key(elm):
+    ''' return a hashable key identifying the content of elm '''
+    return (elm.tag, tuple(sorted(elm.attrib.items())), elm.text,
+            tuple(_element_key(child) for child in elm))
+
+
+def _simplify(elm):
+    ''' Return elm with nested and/or operators of the same kind flattened, duplicate
+        operands of and/or removed, and/or with a single operand replaced by the operand
+        and not(not(x)) replaced by x. Unchanged elements are shared, not copied.'''
+    if len(elm) == 0:
+        return elm
+    children = [_simplify(child) for child in elm]
+    if elm.tag in ('and', 'or') and not elm.attrib:
+        flat = []
+        for child in children:
+            if child.tag == elm.tag and not child.attrib and len(child):
+                flat.extend(child)
+            else:
+                flat.append(child)
+        unique = {}
+        for child in flat:
+            unique.setdefault(_element_key(child), child)
+        children = list(unique.values())
+        if len(children) == 1:
+            return children[0]
+    elif elm.tag == 'not' and len(children) == 1:
+        child = children[0]
+        if child.tag == 'not' and len(child) == 1:
+            return child[0]
+    if len(children) == len(elm) and all(a is b for a, b in zip(children, elm)):
+        return elm
+    E = Element(elm.tag, elm.attrib)
+    E.text = elm.text
+    E.extend(children)
+    return E
+
+
 class IsDependency(Validator):
 
     def __init__(self):
@@ -156,15 +259,44 @@ class Cycledefs(Validator):
                         'be CycleDefinition or list of CycleDefinitions/strings\n')
 
 
+@contextmanager
+def workflow_namespace(namespace):
+    ''' Context in which Workflow() shares the state of namespace, yielding namespace
+        Definition modules using Workflow() add to the namespace's workflow when imported
+        or run in the context, so variants of a workflow may be built in one process, on
+        threads each using its own context. The first Workflow() of the namespace sets
+        its scheduler and realtime, Workflow(namespace=namespace) returns it afterwards.
+        Namespaces are kept until clear_namespace.'''
+    token = Borg._namespace.set(namespace)
+    try:
+        yield namespace
+    finally:
+        Borg._namespace.reset(token)
+
+
+def clear_namespace(namespace):
+    ''' forget the shared state of namespace; its Workflow objects keep the state '''
+    with Borg._init_lock:
+        Borg._namespaces.pop(namespace, None)
+
+
 class CycleDefinition():
-    # add logic to verify user provides a valid definition
     def __init__(self, group, definition, activation_offset=None):
         self.group = str(group)
         self.definition = str(definition)
         self.activation_offset = str(activation_offset)
+        self._parsed = parse_definition(self.definition)  # raises error if not valid
+        if activation_offset is not None:
+            _offset_seconds(self.activation_offset)
+
+    def cycles(self, start, end):
+        ''' return numpy datetime64[m] array of the cycle times from start to end inclusive
+            start and end may be datetime, datetime64 or string YYYYMMDDhhmm '''
+        return self._parsed.cycles(start, end)
 
     def __repr__(self):
-        return "CycleDefinition({!r})".format(self.__dict__)
+        return "CycleDefinition({!r})".format({k: v for k, v in self.__dict__.items()
+                                               if k != '_parsed'})
 
     def __eq__(self, other):
         if isinstance(other, CycleDefinition):
@@ -177,6 +309,10 @@ class CycleDefinition():
     def __hash__(self):
         return hash(self.group)
 
+    def content_hash(self):
+        ''' return hex digest of the cycle definition, stable across runs '''
+        return _digest([self.group, self.definition, self.activation_offset])
+
     def _generate_xml(self):
         cycledef_element = Element('cycledef', group=self.group)
         cycledef_element.text = self.definition
@@ -185,6 +321,32 @@ class CycleDefinition():
         return cycledef_element
 
 
+def _digest(value, size=16):
+    ''' return hex digest of size bytes of the canonical json of value '''
+    if isinstance(value, Dependency):
+        # _simplify gives equal dependencies equal elements
+        value = ('dependency', _element_key(_simplify(value.elm)))
+    if isinstance(value, (str, tuple)):
+        return _cached_digest(value, size)
+    text = json.dumps(value, sort_keys=True, separators=(',', ':'), default=_canonical)
+    return hashlib.blake2b(text.encode(), digest_size=size).hexdigest()
+
+
+@lru_cache(maxsize=2**16)
+def _cached_digest(value, size):
+    ''' digest of the str or tuple values that are repeated by many tasks '''
+    text = value if isinstance(value, str) else json.dumps(value, separators=(',', ':'))
+    return hashlib.blake2b(f'{type(value).__name__}:{text}'.encode(),
+                           digest_size=size).hexdigest()
+
+
+def _canonical(value):
+    ''' json representation of the validated values that json does not serialize '''
+    if isinstance(value, Offset):
+        return {'value': value.value, 'offset': value.offset}
+    raise TypeError(f'Can not hash {value!r}')
+
+
 def _cyclestr(element):
     ''' Wrap text elements containing '@' for syclestr information with cyclestr tag.
         Elements that do not contain '@' are returned unchanged'''
@@ -201,84 +363,567 @@ def _cyclestr(element):
     return element
 
 
+def _escape(data):
+    ''' escape text the same way minidom does when writing xml '''
+    if '&' in data:
+        data = data.replace('&', '&amp;')
+    if '<' in data:
+        data = data.replace('<', '&lt;')
+    if '"' in data:
+        data = data.replace('"', '&quot;')
+    if '>' in data:
+        data = data.replace('>', '&gt;')
+    return data
+
+
+def _text(data):
+    ''' line endings in text are normalized by any xml parser '''
+    if '\r' in data:
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+    return data
+
+
+def _start_tag(elem):
+    ''' return the unclosed start tag of elem with its attributes '''
+    attrs = ''.join(f' {name}="{_escape(value)}"' for name, value in elem.attrib.items())
+    return f'<{elem.tag}{attrs}'
+
+
+def _pretty_xml(elem, indent='', addindent='    ', newl='\n', escape=_escape):
+    ''' Yield the pretty printed xml of elem in pieces.
+        Output is identical to serializing elem with tostring, reparsing it with minidom
+        and calling toprettyxml, but no intermediate string or DOM is built.
+        escape is used for the text of elements holding only text.'''
+    tag = elem.tag
+    yield indent + _start_tag(elem)
+    # minidom sees text and tails as text nodes between the child elements
+    nodes = []
+    if elem.text:
+        nodes.append(_text(elem.text))
+    for child in elem:
+        nodes.append(child)
+        if child.tail:
+            nodes.append(_text(child.tail))
+    if not nodes:
+        yield f'/>{newl}'
+        return
+    yield '>'
+    if len(nodes) == 1 and isinstance(nodes[0], str):
+        yield escape(nodes[0])
+    else:
+        yield newl
+        subindent = indent + addindent
+        for node in nodes:
+            if isinstance(node, str):
+                yield _escape(f'{subindent}{node}{newl}')
+            else:
+                yield from _pretty_xml(node, subindent, addindent, newl, escape)
+        yield indent
+    yield f'</{tag}>{newl}'
+
+
+def _text_values(elem, hint=None):
+    ''' yield (name hint, text) for the elements within elem holding only text
+        The hint is the tag of the element, or the envar name for an envar's value.'''
+    if elem.tag == 'envar':
+        hint = elem.findtext('name')
+    elif elem.tag not in ('value', 'cyclestr'):
+        hint = elem.tag
+    if len(elem) == 0:
+        if elem.text:
+            yield hint, _text(elem.text)
+        return
+    for child in elem:
+        yield from _text_values(child, hint)
+
+
+class _Entities:
+    ''' XML entities declared for text values repeated within a workflow
+        Instances are called to escape text, referencing an entity for text declared as
+        one or for its leading directory path.'''
+    min_count = 2  # a value is declared once used at least this many times
+    min_length = 8  # and is at least this long
+
+    def __init__(self, elements):
+        values = Counter(chain.from_iterable(map(_text_values, elements)))
+        counts = Counter()
+        hints = {}
+        for (hint, value), n in values.items():
+            counts[value] += n
+            hints.setdefault(value, hint)
+        self.names = {}  # value -> entity name
+        used = set()
+        for value, n in counts.items():
+            if self._worthwhile(value, n):
+                self.names[value] = self._name(hints[value], used)
+        # leading directories of the other values
+        rest = [(v, n) for v, n in counts.items() if v not in self.names]
+        prefix_counts = Counter()
+        for value, n in rest:
+            for prefix in self._prefixes(value):
+                prefix_counts[prefix] += n
+        chosen = {}
+        for value, n in rest:
+            for prefix in self._prefixes(value, longest_first=True):
+                if self._worthwhile(prefix, prefix_counts[prefix]):
+                    chosen[value] = prefix
+                    break
+        uses = Counter()
+        for value, n in rest:
+            if value in chosen:
+                uses[chosen[value]] += n
+        self.prefixes = {}
+        for prefix, n in uses.items():
+            if self._worthwhile(prefix, n):
+                self.prefixes[prefix] = self._name(self._prefix_hint(prefix), used)
+        self.declared = sorted(chain(self.names.items(), self.prefixes.items()),
+                               key=lambda item: item[1])
+
+    def _worthwhile(self, value, n):
+        return n >= self.min_count and len(value) >= self.min_length
+
+    @staticmethod
+    def _prefixes(value, longest_first=False):
+        ''' directory paths leading value, ending with / '''
+        ends = [ix + 1 for ix, c in enumerate(value) if c == '/' and ix > 0]
+        if longest_first:
+            ends.reverse()
+        return [value[:end] for end in ends if end < len(value)]
+
+    @staticmethod
+    def _prefix_hint(prefix):
+        for part in reversed(prefix.split('/')):
+            if re.fullmatch('[A-Za-z][A-Za-z0-9_.-]*', part):
+                return f'{part}_dir'
+        return 'path'
+
+    @staticmethod
+    def _name(hint, used):
+        name = re.sub('[^A-Za-z0-9_]', '_', hint or 'text').upper()
+        if not re.match('[A-Z_]', name):
+            name = f'_{name}'
+        unique = name
+        for n in count(2):
+            if unique not in used:
+                break
+            unique = f'{name}{n}'
+        used.add(unique)
+        return unique
+
+    def doctype(self):
+        ''' return the DOCTYPE declaring the entities '''
+        # references in entity values are parsed where the entity is used, but % would
+        # start a parameter entity reference where it is declared
+        values = (_escape(value).replace('%', '&#37;') for value, _ in self.declared)
+        declarations = ''.join(f'    <!ENTITY {name} "{value}">\n'
+                               for (_, name), value in zip(self.declared, values))
+        return f'<!DOCTYPE workflow [\n{declarations}]>\n'
+
+    def __call__(self, text):
+        name = self.names.get(text)
+        if name is not None:
+            return f'&{name};'
+        if self.prefixes:
+            for prefix in self._prefixes(text, longest_first=True):
+                name = self.prefixes.get(prefix)
+                if name is not None:
+                    return f'&{name};{_escape(text[len(prefix):])}'
+        return _escape(text)
+
+
+def _call(func):
+    ''' call func; used to run builder functions on an executor '''
+    return func()
+
+
 class Workflow(Borg):
     ''' Implement an abstarction layer on top of rocoto workflow management engine
         The WorkFlow class will serve as a central object that registers all units of work
         (tasks) for any number of desired cycle definitions.
-        Workflow objects share state.
+        Workflow objects share state; changes to the state are made holding self._lock so
+        that a workflow may be built from several threads.
+        With defer_validation, tasks are not validated as they are added but together by
+        validate, which write_xml and the methods analyzing the tasks call. It is set by
+        the first Workflow made of the shared state.
+        Workflows of the same namespace share state, independent of other namespaces;
+        without namespace the namespace of workflow_namespace, if any, is used.
     '''
 
-    def __init__(self, realtime='T', scheduler='lsf', _shared=True, **kwargs):
-        if _shared:
-            Borg.__init__(self)
-        if not hasattr(self, 'tasks'):
-            self.tasks = []
-            self.task_names = set()  # set of unique task names, metatasks are expended.
-            self.metatask_names = set()
-            self.cycle_definitions = dict()
-
-            self.workflow_element = Element('workflow', realtime=realtime,
-                                            scheduler=scheduler, **kwargs)
-            self.log_element = None
+    def __init__(self, realtime='T', scheduler='lsf', _shared=True, defer_validation=False,
+                 namespace=None, **kwargs):
+        with Borg._init_lock:
+            if _shared:
+                Borg.__init__(self, namespace)
+            if not hasattr(self, 'tasks'):
+                self._init_state(realtime, scheduler, defer_validation, **kwargs)
+
+    def _init_state(self, realtime, scheduler, defer_validation=False, **kwargs):
+        self._lock = RLock()
+        self._builders = []  # functions registered with task(defer=True)
+        self._defer_validation = defer_validation
+        self._unvalidated = []  # tasks added with defer_validation, not yet validated
+        self.tasks = []
+        self.task_names = set()  # set of unique task names, metatasks are expended.
+        self.metatask_names = set()
+        self.cycle_definitions = dict()
+        # dependency graph index, task names are expanded metatask names
+        # task name -> refs (tag, name, cycle_offset) it depends on, tasks with refs only
+        self._upstream = dict()
+        self._downstream = dict()  # (tag, name) -> set of task names depending on it
+        self._metatask_members = dict()  # metatask name -> task names
+        self._metatask_of = dict()  # task name -> metatask name
+
+        self.workflow_element = Element('workflow', realtime=realtime,
+                                        scheduler=scheduler, **kwargs)
+        self.log_element = None
 
     def define_cycle(self, group, definition, activation_offset=None):
         cycledef = CycleDefinition(group, definition, activation_offset)
-        if group in self.cycle_definitions:
-            if cycledef == self.cycle_definitions[group]:
-                return cycledef
+        with self._lock:
+            if group in self.cycle_definitions:
+                if cycledef == self.cycle_definitions[group]:
+                    return cycledef
+                else:
+                    raise ValueError('cannot add different cycle definition with same group '
+                                     'name')
             else:
-                raise ValueError('cannot add different cycle definition with same group name')
-        else:
-            self.cycle_definitions[cycledef.group] = cycledef
-            return cycledef
+                self.cycle_definitions[cycledef.group] = cycledef
+                return cycledef
 
     def set_log(self, logfile):
         log = Element('log')
         log.text = logfile
         self.log_element = _cyclestr(log)
 
-    def _validate_task_dependencies(self, task):
-        if hasattr(task, 'dependency'):
-            for elm in task.dependency.to_element().iter():
-                if elm.tag == 'taskdep':
-                    if elm.attrib['task'] not in self.task_names:
-                        n = elm.attrib['task']
-                        raise ValueError(f'Task depenency {repr(n)} is not in workflow')
-                if elm.tag == 'metataskdep':
-                    if elm.attrib['metatask'] not in self.metatask_names:
-                        n = elm.attrib['metatask']
-                        raise ValueError(f'Metatask dependency {repr(n)} is not in workflowa')
-
-    def _validate_task_cycles(self, task):
-        for cycledef in task.cycledefs:
-            if cycledef not in self.cycle_definitions:
-                raise ValueError(f'cycle definition "{cycledef}" not in workflow')
-
-    def add_task(self, task):
-        task._validate()  # will raise error if eggregate of task info appears to have issues
-        self._validate_task_dependencies(task)  # will raise errors if task dependency issues
-        self._validate_task_cycles(task)  # will raise errors if task cycle issues
-#        for cycledef in task.cycledefs:
-#            if isinstance(cycledef, str):
-#                if cycledef in self.cycle_definitions:
-#                    continue
-#                else:
-#                    raise ValueError(f'cycle with group name {cycledef} does not exist')
-#            if isinstance(cycledef, CycleDefinition):
-#                if cycledef.group not in self.cycle_definitions:
-#                    self.cycle_definitions[cycledef.group] = cycledef
-#                continue
-#            else:
-#                raise ValueError(f'{cycledef} is not a cycle definition')
-        self.tasks.append(task)
-        if not self.task_names.isdisjoint(task.task_names):  # if intersection
-            raise ValueError(f'Task names must be unique; Error adding task {repr(task.name)}')
+    def _index_task_dependencies(self, task, columns=None):
+        ''' add the dependencies of task to the dependency graph index '''
+        metatask_name = getattr(task, 'metatask_name', None)
+        if metatask_name is not None:
+            self._metatask_members[metatask_name] = members = []
+        refs = task.dependency.refs if hasattr(task, 'dependency') else ()
+        if any('#' in n for _, n, _ in refs) and hasattr(task, 'meta'):
+            # metatask variables are substituted into each task's dependencies
+            task_refs = (tuple((tag, _substitute_meta(n, meta), offset)
+                               for tag, n, offset in refs)
+                         for _, meta in task._members(columns))
         else:
-            self.task_names.update(task.task_names)
-        if hasattr(task, 'metatask_name'):
-            self.metatask_names.add(task.metatask_name)
+            task_refs = repeat(refs)
+        for name, name_refs in zip(task._iter_names(columns), task_refs):
+            if metatask_name is not None:
+                members.append(name)
+                self._metatask_of[name] = metatask_name
+            if name_refs:
+                self._upstream[name] = name_refs
+            for tag, n, _ in name_refs:
+                self._downstream.setdefault((tag, n), set()).add(name)
+
+    def _unindex_task_dependencies(self, task):
+        ''' remove the dependencies of task from the dependency graph index '''
+        for name, _ in task._members():
+            for tag, n, _ in self._upstream.pop(name, ()):
+                dependents = self._downstream[(tag, n)]
+                dependents.discard(name)
+                if not dependents:
+                    del self._downstream[(tag, n)]
+
+    def _dependency_errors(self, exclude=()):
+        ''' return errors for dependencies on tasks or metatasks that are not in the workflow
+            other than those named in exclude. Dependencies are resolved after all tasks are
+            added, so tasks may be added in any order '''
+        missing = []
+        for (tag, n), names in self._downstream.items():
+            if n in exclude:
+                continue
+            if tag == 'taskdep' and n not in self.task_names:
+                missing.append(f'Task dependency {n!r} of {sorted(names)} is not in workflow')
+            elif tag == 'metataskdep' and n not in self.metatask_names:
+                missing.append(f'Metatask dependency {n!r} of {sorted(names)} '
+                               'is not in workflow')
+        return missing
+
+    def validate(self):
+        ''' Return a list of every problem found in the workflow, empty when it is valid
+            Tasks awaiting deferred validation are validated together and those without
+            errors are added. Dependencies on tasks or metatasks not in the workflow and
+            dependency cycles are reported too.'''
+        with self._lock:
+            errors, failed = self._validate_deferred()
+            errors.extend(self._dependency_errors(exclude=failed))
+            errors.extend(f'Task dependency cycle found: {" <-> ".join(c)}'
+                          for c in self._cycles())
+            return errors
+
+    def _validate_deferred(self):
+        ''' add the tasks awaiting deferred validation that are valid
+            Return the errors of the others, which are kept waiting, and their names.'''
+        if not self._unvalidated:
+            return [], set()
+        tasks, self._unvalidated = self._unvalidated, []
+        errors, failed = self._insert_tasks(tasks, partial=True)
+        self._unvalidated = failed
+        names = set()
+        for task in failed:
+            try:
+                names.update(task._iter_names())
+            except (AttributeError, ValueError):
+                names.add(getattr(task, 'name', None))
+            names.add(getattr(task, 'metatask_name', None))
+        return errors, names
+
+    def _require_valid(self):
+        ''' raise the errors of the tasks awaiting deferred validation '''
+        with self._lock:
+            errors, _ = self._validate_deferred()
+            if errors:
+                raise ValueError(_report(errors, 'adding tasks'))
+
+    def _dependency_names(self, tag, n):
+        ''' return the task names referenced by a taskdep or metataskdep '''
+        if tag == 'metataskdep':
+            return self._metatask_members.get(n, [])
+        return [n] if n in self.task_names else []
+
+    def _same_cycle_upstream(self, name):
+        ''' return names of tasks in the same cycle that task name depends on
+            in the order they are referenced '''
+        upstream = {}
+        for tag, n, offset in self._upstream.get(name, ()):
+            if offset is None or _offset_seconds(offset) == 0:
+                upstream.update(dict.fromkeys(self._dependency_names(tag, n)))
+        return upstream
+
+    def _offset_upstream(self, name):
+        ''' yield (name, cycle_offset seconds) of the tasks that task name depends on '''
+        for tag, n, offset in self._upstream.get(name, ()):
+            seconds = 0 if offset is None else _offset_seconds(offset)
+            for m in self._dependency_names(tag, n):
+                yield m, seconds
+
+    def _analyze_dependencies(self):
+        ''' return strongly connected components of the same cycle dependency graph,
+            ordered so that each component follows those it depends on '''
+        names = chain.from_iterable(task._iter_names() for task in self.tasks)
+        return _strongly_connected(names, self._same_cycle_upstream)
+
+    def find_cycles(self):
+        ''' return a list of dependency cycles; each is a sorted list of task names.
+            A cycle is a task depending on itself in the same cycle, directly or through
+            other tasks; the cycle_offsets of the dependencies around it add up to zero,
+            as with a depending on b at +01:00:00 and b on a at -01:00:00.'''
+        self._require_valid()
+        return self._cycles()
+
+    def _cycles(self):
+        names = chain.from_iterable(task._iter_names() for task in self.tasks)
+        return [sorted(cycle) for cycle in _zero_weight_cycles(names, self._offset_upstream)]
+
+    def _check_cycles(self):
+        cycles = self._cycles()
+        if cycles:
+            raise ValueError('Task dependency cycles found:\n' +
+                             '\n'.join(' <-> '.join(c) for c in cycles))
+
+    def topological_order(self):
+        ''' return task names ordered such that each task follows the tasks it depends on
+            within the same cycle; otherwise the order tasks were added is kept'''
+        self._require_valid()
+        self._check_cycles()
+        return [scc[0] for scc in self._analyze_dependencies()]
+
+    def _ordered_tasks(self):
+        ''' return tasks in topological order of the tasks (metatasks) themselves '''
+        task_of = {}
+        for task in self.tasks:
+            for n, _ in task._members():
+                task_of[n] = task
+        position = {id(task): ix for ix, task in enumerate(self.tasks)}
+
+        def upstream(task):
+            ''' tasks containing the same cycle dependencies of task's members '''
+            found = {}
+            for n, _ in task._members():
+                for m in self._same_cycle_upstream(n):
+                    up = task_of[m]
+                    if up is not task:
+                        found[id(up)] = up
+            return found.values()
+
+        ordered = []
+        for scc in _strongly_connected(self.tasks, upstream, key=id):
+            # metatasks whose members depend on each other in turn keep their order
+            ordered.extend(sorted(scc, key=lambda task: position[id(task)]))
+        return ordered
+
+    def reduce_dependencies(self):
+        ''' Remove task dependencies that are implied by other dependencies of the same task.
+            For example and(TaskDep('a'), TaskDep('b')) becomes TaskDep('b') when task b
+            requires task a to succeed in the same cycle.
+            Only same cycle taskdeps that must be satisfied (reached through and only) are
+            removed. Return the number of taskdep nodes removed.'''
+        self._require_valid()
+        self._check_cycles()
+        member_of = {}
+        for task in self.tasks:
+            for n, meta in task._members():
+                member_of[n] = (task, meta)
+        required = {}
+
+        def required_upstream(name):
+            ''' names of tasks that must have succeeded in the same cycle for name to run '''
+            if name not in required:
+                task, meta = member_of[name]
+                names = []
+                if hasattr(task, 'dependency'):
+                    for E in _required_elements(task.dependency.elm):
+                        n = _substitute_meta(E.attrib[_ref_attr[E.tag]], meta)
+                        names.extend(self._dependency_names(E.tag, n))
+                required[name] = names
+            return required[name]
+
+        removed = 0
+        for task in self.tasks:
+            if not hasattr(task, 'dependency'):
+                continue
+            leaves = [E for E in _required_elements(task.dependency.elm) if E.tag == 'taskdep']
+            if len(leaves) < 2:
+                continue
+            # a leaf is redundant if it is required by another leaf for every metatask member
+            redundant = {id(E) for E in leaves}
+            for name, meta in task._members():
+                targets = {id(E): _substitute_meta(E.attrib['task'], meta) for E in leaves}
+                implied = _reachable(targets.values(), required_upstream)
+                redundant = {k for k in redundant if targets[k] in implied}
+                if not redundant:
+                    break
+            if redundant:
+                self._unindex_task_dependencies(task)
+                task.dependency = Dependency(_without_elements(task.dependency.elm, redundant))
+                self._index_task_dependencies(task)
+                removed += len(redundant)
+        logger.info(f'removed {removed} redundant task dependencies')
+        return removed
+
+    def upstream(self, name, recursive=False):
+        ''' return names of the tasks that task name depends on
+            With recursive, return all tasks it depends on directly or indirectly'''
+        self._require_valid()
+        if name not in self.task_names:
+            raise ValueError(f'Task {name!r} is not in workflow')
+        found = set()
+        todo = [name]
+        while todo:
+            for tag, n, _ in self._upstream.get(todo.pop(), ()):
+                new = set(self._dependency_names(tag, n)) - found
+                found.update(new)
+                if recursive:
+                    todo.extend(new)
+        return found
+
+    def downstream(self, name, recursive=False):
+        ''' return names of the tasks that depend on task name
+            With recursive, return all tasks that depend on it directly or indirectly'''
+        self._require_valid()
+        if name not in self.task_names:
+            raise ValueError(f'Task {name!r} is not in workflow')
+        found = set()
+        todo = [name]
+        while todo:
+            n = todo.pop()
+            new = set(self._downstream.get(('taskdep', n), ()))
+            if n in self._metatask_of:
+                new.update(self._downstream.get(('metataskdep', self._metatask_of[n]), ()))
+            new -= found
+            found.update(new)
+            if recursive:
+                todo.extend(new)
+        return found
 
-    def task(self):
+    def add_task(self, task):
+        self.add_tasks((task,))
+
+    def add_tasks(self, tasks):
+        ''' Add the tasks of iterable tasks, which may be a generator
+            The batch is validated as a whole and every problem found is reported in a
+            single ValueError; either all of the tasks are added or none of them are.'''
+        tasks = list(tasks)
+        with self._lock:
+            self._add_tasks(tasks)
+
+    def _add_tasks(self, tasks):
+        if self._defer_validation:
+            self._unvalidated.extend(tasks)
+            return
+        errors, _ = self._insert_tasks(tasks)
+        if errors:
+            raise ValueError(_report(errors, 'adding tasks'))
+
+    def _insert_tasks(self, tasks, partial=False):
+        ''' validate and add tasks, return the errors found and the tasks with errors
+            With errors, none of the tasks are added unless partial, when the tasks
+            without errors are.'''
+        errors = []
+        failed = []
+        metatask_names = set()
+        columns_of = []
+        # names are streamed from the tasks into task_names, metatask names are not held by
+        # the task; they are removed again if the batch has errors or raises
+        try:
+            for ix, task in enumerate(tasks):
+                task_errors, columns = self._check_task(ix, task, metatask_names)
+                if task_errors:
+                    errors.extend(task_errors)
+                    failed.append(task)
+                    continue
+                if hasattr(task, 'metatask_name'):
+                    metatask_names.add(task.metatask_name)
+                columns_of.append((task, columns))
+        except BaseException:
+            for task, columns in columns_of:
+                self.task_names.difference_update(task._iter_names(columns))
+            raise
+        if errors and not partial:
+            for task, columns in columns_of:
+                self.task_names.difference_update(task._iter_names(columns))
+            return errors, failed
+        self.tasks.extend(task for task, _ in columns_of)
+        self.metatask_names |= metatask_names
+        for task, columns in columns_of:
+            self._index_task_dependencies(task, columns)
+        return errors, failed
+
+    def _check_task(self, ix, task, metatask_names):
+        ''' validate task ix of a batch adding metatask_names, return its errors and meta
+            columns; the names of a task without errors are added to task_names '''
+        if not isinstance(task, Task):
+            return [f'task #{ix}: Expected a Task, but got {type(task)}'], None
+        label = f'task {task.name!r}' if hasattr(task, 'name') else f'task #{ix}'
+        # will report errors if eggregate of task info appears to have issues
+        task_errors = list(task._validation_errors())
+        if hasattr(task, 'cycledefs'):
+            task_errors.extend(f'cycle definition "{cycledef}" not in workflow'
+                               for cycledef in task.cycledefs
+                               if cycledef not in self.cycle_definitions)
+        try:
+            columns = task._meta_columns()  # raises if meta vars are not equal length
+        except ValueError as e:
+            task_errors.append(str(e))
+        if task_errors or not hasattr(task, 'name'):
+            return [f'{label}: {error}' for error in task_errors], None
+        metatask_name = getattr(task, 'metatask_name', None)
+        if metatask_name in self.metatask_names or metatask_name in metatask_names:
+            return [f'Metatask names must be unique; Error adding task {task.name!r} '
+                    f'with metatask name {metatask_name!r}'], None
+        names = list(task._iter_names(columns))
+        if not self.task_names.isdisjoint(names):  # if intersection
+            return [f'Task names must be unique; Error adding task {task.name!r}'], None
+        ntask_names = len(self.task_names)
+        self.task_names.update(names)
+        if len(self.task_names) - ntask_names != len(names):
+            self.task_names.difference_update(names)
+            return [f'{label}: meta variables must produce unique tasks'], None
+        return [], columns
+
+    def task(self, defer=False):
         ''' decorator used to associate tasks with workflow
             Use to wrap functions that will return task object
 
@@ -286,49 +931,396 @@ class Workflow(Borg):
         def task():
             namespace for defining task
             return Task(locals())
+
+            With defer, the function is not called but registered to be called by build
+            and is returned unchanged.
         '''
         def decorator(func):
+            if defer:
+                with self._lock:
+                    self._builders.append(func)
+                return func
             task = func()
             self.add_task(task)
             logger.info(f'adding task {repr(task.name)}')
         return decorator
 
-    @staticmethod
-    def prettify(elem):
-        rough_string = tostring(elem, 'UTF-8')
-        reparsed = minidom.parseString(rough_string)
-        return reparsed.toprettyxml(indent="    ", encoding=None)
+    def build(self, executor='thread', max_workers=None, cache=None, inputs=()):
+        ''' Call the functions registered with task(defer=True) and add their tasks
+            The functions run concurrently on a 'thread' or 'process' pool of max_workers,
+            on a concurrent.futures.Executor, or one after another with executor None.
+            Their tasks are added together with add_tasks in the order the functions were
+            registered, so the workflow is the same however it is built. Functions run on
+            a process pool must be importable by the worker processes.
+            With cache, a path, the built workflow is saved there as a snapshot keyed by
+            the source files of the functions and pyrocoto and the contents of the files
+            in inputs. When the key matches, the workflow is loaded from the snapshot in
+            place of calling the functions. Everything the functions and the workflow
+            before build depend on must be in those files.
+            Return the list of tasks added.'''
+        with self._lock:
+            builders = list(self._builders)
+        if cache is not None:
+            cache = os.path.expanduser(cache)
+            key = _snapshot_key(builders, inputs)
+            snapshot = _load_snapshot(cache, key)
+            if snapshot is not None:
+                # the built tasks are saved with the workflow, they may await validation
+                snapshot, tasks = snapshot
+                with self._lock:
+                    vars(self).update(snapshot.__getstate__())
+                    del self._builders[:len(builders)]
+                logger.info(f'loaded {len(tasks)} tasks from {cache}')
+                return tasks
+        if executor is None:
+            tasks = [func() for func in builders]
+        elif isinstance(executor, Executor):
+            tasks = list(executor.map(_call, builders))
+        elif executor in ('thread', 'process'):
+            pool_class = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+            with pool_class(max_workers) as pool:
+                tasks = list(pool.map(_call, builders))
+        else:
+            raise ValueError(f"Expected executor to be 'thread', 'process', None or an "
+                             f"Executor, but got {executor!r}")
+        with self._lock:
+            self._add_tasks(tasks)
+            del self._builders[:len(builders)]
+            if cache is not None:
+                _replace(cache, [pickle.dumps(key, pickle.HIGHEST_PROTOCOL),
+                                 pickle.dumps((self, tasks), pickle.HIGHEST_PROTOCOL)])
+        for task in tasks:
+            logger.info(f'adding task {repr(task.name)}')
+        return tasks
 
-    def write_xml(self, xmlfile, cycledefs=None):
-        ''' write xml workflow.
-        '''
+    def partition(self, by='component', sentinel_dir='sentinels', log=None):
+        ''' Return a Partition of the workflow into independent workflows, see
+            pyrocoto.partition '''
+        from .shards import partition
+        return partition(self, by, sentinel_dir, log)
 
-        xml = self.workflow_element
-        xml.append(self.log_element)
+    def __getstate__(self):
+        ''' pickle the workflow without its lock and the functions not yet built
+            The unpickled workflow does not share state with other workflows.'''
+        with self._lock:
+            return {k: v for k, v in vars(self).items() if k not in ('_lock', '_builders')}
 
-        for cycledef in self.cycle_definitions.values():
-            E = cycledef._generate_xml()
-            xml.append(E)
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self._lock = RLock()
+        self._builders = []
 
+    @staticmethod
+    def prettify(elem):
+        return '<?xml version="1.0" ?>\n' + ''.join(_pretty_xml(elem))
+
+    def _generate_xml(self):
+        ''' Return a new workflow element holding the log, cycle definitions and tasks '''
+        xml = Element(self.workflow_element.tag, self.workflow_element.attrib)
+        xml.extend(self._header_elements())
         for task in self.tasks:
-            E = task._generate_xml()
-            xml.append(E)
+            xml.append(task._generate_xml())
+        return xml
 
-        with open(xmlfile, 'w') as f:
-            f.write('<?xml version="1.0"?>\n<!DOCTYPE workflow []>')
-            f.write(self.prettify(self.workflow_element)[22:])
+    def _header_elements(self):
+        ''' yield the elements that precede the tasks '''
+        if self.log_element is not None:
+            yield self.log_element
+        for cycledef in self.cycle_definitions.values():
+            yield cycledef._generate_xml()
+
+    def write_xml(self, xmlfile, cycledefs=None, ordered=False, processes=None,
+                  entities=False, incremental=False):
+        ''' write xml workflow.
+            xmlfile may be a path or a file-like object.
+            With ordered, tasks are written in topological order so that tasks follow
+            the tasks they depend on, otherwise tasks are written in the order added.
+            With processes, the xml of tasks that is not already cached is generated by
+            a pool of that many processes; the output is the same. The pool is started
+            without forking this process and runs after the workflow is released, so
+            other threads may use the workflow meanwhile.
+            With entities, text values and leading directory paths repeated in the
+            workflow are declared as ENTITYs in the DOCTYPE and referenced where used.
+            With incremental, xmlfile must be a path and a manifest of the content hashes
+            of what was written is kept in xmlfile.manifest.json. The file is not touched
+            when nothing changed, otherwise the xml of unchanged tasks is copied from it
+            rather than generated. The diff from the previous write is returned, see diff.
+            The workflow is not modified, so it may be written any number of times.
+        '''
+        with self._lock:
+            errors = self.validate()
+            if errors:
+                raise ValueError(_report(errors, 'in workflow'))
+            tasks = self._ordered_tasks() if ordered else list(self.tasks)
+            if incremental:
+                if entities:
+                    raise ValueError('entities can not be written incrementally')
+                if hasattr(xmlfile, 'write'):
+                    raise TypeError('Expected xmlfile to be a path to write incrementally')
+                diff, job = self._write_incremental(os.path.expanduser(xmlfile), tasks)
+                if job is None:
+                    return diff
+            else:
+                diff, job = None, self._write(xmlfile, tasks, entities)
+            tasks, escape, finish = job
+            if processes is None or processes < 2:
+                # task xml is cached by each task
+                finish(map(_task_xml, tasks, repeat(escape)))
+                return diff
+            cached = [task._xml() if escape is None and task._xml_cache is not None else None
+                      for task in tasks]
+        finish(_parallel_xml(tasks, cached, escape, processes))
+        return diff
+
+    def _write(self, xmlfile, tasks, entities=False):
+        ''' return (tasks, escape, finish) to write the pretty printed workflow to xmlfile
+            finish(xml) writes it given the xml of the tasks, with escape '''
+        escape = None
+        if entities:
+            escape = _Entities(chain(self._header_elements(),
+                                     (task._generate_xml() for task in tasks)))
+        header = self._header_xml(escape)
+        footer = f'</{self.workflow_element.tag}>\n'
+
+        def write(f, xml):
+            f.write(header)
+            f.writelines(xml)
+            f.write(footer)
+
+        def finish(xml):
+            if hasattr(xmlfile, 'write'):
+                write(xmlfile, xml)
+            else:
+                with open(xmlfile, 'w') as f:
+                    write(f, xml)
+        return tasks, escape, finish
+
+    def _header_xml(self, escape=None):
+        ''' return the pretty printed xml preceding the tasks '''
+        doctype = '<!DOCTYPE workflow []>\n' if escape is None else escape.doctype()
+        header = ['<?xml version="1.0"?>\n', doctype, _start_tag(self.workflow_element),
+                  '>\n']
+        for E in self._header_elements():
+            header.extend(_pretty_xml(E, indent='    ', escape=escape or _escape))
+        return ''.join(header)
+
+    def _manifest(self, tasks):
+        ''' return the content hashes of the workflow for incremental writes and diff '''
+        workflow = {'attributes': _digest(self.workflow_element.attrib),
+                    'log': _digest(None if self.log_element is None else
+                                   tostring(self.log_element, encoding='unicode'))}
+        return {'format': _manifest_format,
+                'workflow': workflow,
+                'cycledefs': {group: cycledef.content_hash()
+                              for group, cycledef in self.cycle_definitions.items()},
+                'tasks': {key: {'hash': _digest(fields), 'fields': fields}
+                          for key, fields in zip(_task_keys(tasks),
+                                                 (task.field_hashes() for task in tasks))}}
+
+    def diff(self, xmlfile, ordered=False):
+        ''' Return the differences of the workflow from what was written to xmlfile with
+            write_xml(incremental=True) as a dict of
+            added, removed: lists of task names
+            changed: dict of task name to the list of its attributes that changed
+            cycledefs: dict of added, removed and changed lists of cycle definition groups
+            workflow: list of what changed of the workflow 'attributes' and 'log'
+            written: whether xmlfile was written, always False here
+            Tasks of metatasks are named by the task's name, with meta variables, or by
+            the name of its first task where several tasks have the same name.'''
+        with self._lock:
+            self._require_valid()
+            tasks = self._ordered_tasks() if ordered else self.tasks
+            return _diff(_read_manifest(os.path.expanduser(xmlfile)), self._manifest(tasks))
+
+    def _write_incremental(self, xmlfile, tasks):
+        ''' return the diff of tasks from the previous write of xmlfile and the
+            (tasks, escape, finish) of _write for the tasks that changed, or None when
+            nothing did '''
+        previous = _read_manifest(xmlfile)
+        manifest = self._manifest(tasks)
+        diff = _diff(previous, manifest)
+        # xml of the previous write, if the file is as written then
+        old = None
+        if previous['tasks'] and os.path.exists(xmlfile):
+            with open(xmlfile, 'rb') as f:
+                old = f.read()
+            if _digest_bytes(old) != previous.get('digest'):
+                old = None
+        old_tasks = previous['tasks'] if old is not None else {}
+        header = self._header_xml().encode()
+        header_digest = _digest_bytes(header)
+        same = [old_tasks.get(key, {}).get('hash') == entry['hash']
+                for key, entry in manifest['tasks'].items()]
+        if (old is not None and all(same) and header_digest == previous.get('header') and
+                list(old_tasks) == list(manifest['tasks'])):
+            diff['written'] = False
+            return diff, None
+        changed = [task for task, unchanged in zip(tasks, same) if not unchanged]
+        footer = f'</{self.workflow_element.tag}>\n'.encode()
+
+        def finish(changed_xml):
+            changed_xml = iter(changed_xml)
+            pieces = [header]
+            offset = len(header)
+            for (key, entry), unchanged in zip(manifest['tasks'].items(), same):
+                if unchanged:
+                    start = old_tasks[key]['offset']
+                    piece = old[start:start + old_tasks[key]['length']]
+                else:
+                    piece = next(changed_xml).encode()
+                entry['offset'] = offset
+                entry['length'] = len(piece)
+                offset += len(piece)
+                pieces.append(piece)
+            pieces.append(footer)
+            manifest['header'] = header_digest
+            manifest['digest'] = _digest_bytes(b''.join(pieces))
+            _replace(xmlfile, pieces)
+            _replace(f'{xmlfile}.manifest.json', [json.dumps(manifest).encode()])
+            diff['written'] = True
+        return diff, (changed, None, finish)
+
+
+def _report(errors, what):
+    ''' return message reporting errors '''
+    if len(errors) == 1:
+        return errors[0]
+    return f'{len(errors)} errors {what}:\n' + '\n'.join(errors)
+
+
+_manifest_format = 1  # changed when the xml written for the same content changes
+_snapshot_format = 2  # changed when what Workflow.build snapshots changes
+
+
+def _task_keys(tasks):
+    ''' return the name of each task, or its first task name where names repeat '''
+    counts = Counter(task.name for task in tasks)
+    return [task.name if counts[task.name] == 1 else next(task._iter_names())
+            for task in tasks]
+
+
+def _digest_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _read_manifest(xmlfile):
+    ''' return the manifest of xmlfile, an empty one if missing or of another format '''
+    try:
+        with open(f'{xmlfile}.manifest.json') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {}
+    if manifest.get('format') != _manifest_format:
+        manifest = {'workflow': {}, 'cycledefs': {}, 'tasks': {}}
+    return manifest
+
+
+def _snapshot_key(builders, inputs):
+    ''' return digest of the modules of pyrocoto, the files defining builders and the
+        files inputs '''
+    package = os.path.dirname(__file__)
+    modules = sorted(os.path.join(package, name) for name in os.listdir(package)
+                     if name.endswith('.py'))
+    paths = dict.fromkeys(modules +
+                          [inspect.getfile(func) for func in builders] +
+                          [os.path.expanduser(path) for path in inputs])
+    key = hashlib.blake2b(f'{_snapshot_format}\0'.encode(), digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as f:
+            key.update(f'{path}\0{_digest_bytes(f.read())}\0'.encode())
+    return key.hexdigest()
+
+
+def _load_snapshot(cache, key):
+    ''' return (Workflow, tasks built) saved in cache with key, None when missing or of
+        another key '''
+    try:
+        with open(cache, 'rb') as f:
+            if pickle.load(f) != key:
+                return None
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _replace(path, pieces):
+    ''' write pieces to a new file and replace path with it '''
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        f.writelines(pieces)
+    os.replace(tmp, path)
+
+
+def _diff(previous, manifest):
+    ''' return the differences of manifest from previous, see Workflow.diff '''
+    old, new = previous['tasks'], manifest['tasks']
+    changed = {}
+    for key in new.keys() & old.keys():
+        if new[key]['hash'] != old[key]['hash']:
+            fields, old_fields = new[key]['fields'], old[key]['fields']
+            changed[key] = sorted(name for name in fields.keys() | old_fields.keys()
+                                  if fields.get(name) != old_fields.get(name))
+    old_cycledefs, new_cycledefs = previous['cycledefs'], manifest['cycledefs']
+    return {'added': [key for key in new if key not in old],
+            'removed': [key for key in old if key not in new],
+            'changed': {key: changed[key] for key in new if key in changed},
+            'cycledefs': {'added': [g for g in new_cycledefs if g not in old_cycledefs],
+                          'removed': [g for g in old_cycledefs if g not in new_cycledefs],
+                          'changed': [g for g in new_cycledefs if g in old_cycledefs and
+                                      new_cycledefs[g] != old_cycledefs[g]]},
+            'workflow': [name for name, value in manifest['workflow'].items()
+                         if previous['workflow'].get(name) != value],
+            'written': False}
+
+
+def _task_xml(task, escape=None):
+    ''' return the pretty printed xml of task, its cached xml without escape '''
+    if escape is None:
+        return task._xml()
+    return ''.join(_pretty_xml(task._generate_xml(), indent='    ', escape=escape))
+
+
+def _tasks_xml(tasks, escape=None):
+    ''' return the list of the pretty printed xml of tasks, run by the pool of _parallel_xml '''
+    return [_task_xml(task, escape) for task in tasks]
+
+
+def _parallel_xml(tasks, cached, escape, processes, chunks_per_process=4):
+    ''' yield the pretty printed xml of tasks in order, generating it in processes
+        cached holds the xml of each task that is written as is, otherwise None. Runs of
+        the other tasks are sent to the pool in chunks. The pool's processes are started
+        by a fork server or spawned, never forked from this process, whose other threads
+        may hold locks that would never be released in a forked child.'''
+    size = max(1, -(-cached.count(None) // (processes * chunks_per_process)))
+    chunks = []  # xml text or range of tasks
+    for ix, xml in enumerate(cached):
+        if xml is not None:
+            chunks.append([xml])
+        elif chunks and isinstance(chunks[-1], range) and len(chunks[-1]) < size:
+            chunks[-1] = range(chunks[-1].start, ix + 1)
+        else:
+            chunks.append(range(ix, ix + 1))
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    with ProcessPoolExecutor(processes, mp_context=context) as pool:
+        futures = [chunk if isinstance(chunk, list) else
+                   pool.submit(_tasks_xml, tasks[chunk.start:chunk.stop], escape)
+                   for chunk in chunks]
+        for future in futures:
+            yield from future if isinstance(future, list) else future.result()
 
 
 class Task:
     ''' Implement container for information pertaining to a single task '''
     # validate and track class meta data
-    # note: validated data attributes are added to self._validated by the validators
+    # note: validated data attributes are stored as _<name> by the validators; see _validated
     name = String()  # tasks added to workflow should have unique name
     metatask_name = String()
     jobname = String()
     command = String()
     join = String(contains='/')
     stderr = String(contains='/')
+    stdout = String(contains='/')
     account = String()
     memory = String()  # maybe validate this more
     walltime = String(contains=':')
@@ -337,12 +1329,22 @@ class Task:
     partition = String()
     native = String()
     cores = String()
+    nodes = String()
+    nodesize = String()
     envar = Envar()
     meta = Meta()
     cycledefs = Cycledefs()
     dependency = IsDependency()
     final = String(one_of=['true', 'false'])
 
+    # validated data is held in slots rather than a dict per task; __dict__ keeps other
+    # attributes and the validators of subclasses working
+    __slots__ = tuple(f'_{k}' for k, v in list(locals().items())
+                      if isinstance(v, Validator)) + ('__dict__',)
+
+    # (element, serialized xml) generated from the validated data; reset by the validators
+    _xml_cache = None
+
     defaults = {'maxtries': '2',
                 'walltime': '20:00',
                 'final': 'false'}
@@ -379,13 +1381,22 @@ class Task:
     def __init__(self, d):
         # set some defaults if not already set
         for k, v in self.defaults.items():
-            if not hasattr(self, k):
+            if not hasattr(self, f'_{k}'):
                 setattr(self, k, v)
         # set user passed data that will overwrite any defaults
-        self.task_names = set()
         for var, value in d.items():
             setattr(self, var, value)
 
+    def __getstate__(self):
+        ''' pickle the task's attributes without its cached xml '''
+        state = {k: v for k, v in vars(self).items() if k != '_xml_cache'}
+        return state, {name: getattr(self, name) for name in validated(self) - state.keys()}
+
+    @property
+    def _validated(self):
+        ''' set of the private names of the validated attributes that are set '''
+        return validated(self)
+
     def _validate(self):
         # ensure that metadata that should be diffrent by job is.
         # jobname, join/stderr,
@@ -393,38 +1404,107 @@ class Task:
         # ensure the agregate of data for this task looks ok
         # check for common mistakes that are based on a combination of data
         # single data validation should occur within a validator
+        for error in self._validation_errors():
+            raise ValueError(error)
+
+    def _validation_errors(self):
+        ''' yield a message for each problem found by _validate '''
         for req_attrs in self._required:
-            good = False
-            for attr in req_attrs:
-                if hasattr(self, attr):
-                    good = True
-                    break
-            if not good:
-                raise ValueError(f'Expected one of {repr(req_attrs)} to be set')
-        # store task name(s) in self.task_names
+            if not any(hasattr(self, attr) for attr in req_attrs):
+                yield f'Expected one of {repr(req_attrs)} to be set'
+
+    def field_hashes(self):
+        ''' return dict of the name of each validated attribute to the hex digest of its
+            value; the digests are stable across runs '''
+        return {name[1:]: _digest(getattr(self, name), 8) for name in sorted(self._validated)}
+
+    def content_hash(self):
+        ''' return hex digest of the task's validated attributes, stable across runs '''
+        return _digest(self.field_hashes())
+
+    @property
+    def task_names(self):
+        ''' set of task names; the names of a metatask's tasks '''
+        return set(self._iter_names())
+
+    def _meta_levels(self):
+        ''' return list of meta dicts, one for each level of nested metatasks '''
+        return self.meta if isinstance(self.meta, list) else [self.meta]
+
+    def _meta_keys(self):
+        return tuple(k for level in self._meta_levels() for k in level)
+
+    def _meta_columns(self):
+        ''' return list for each metatask level of the lists of values of each meta variable
+            Callers iterating over the tasks several times may pass it to _iter_names
+            and _members to split the meta variables once'''
         if not hasattr(self, 'meta'):
-            self.task_names.add(self.name)
-        else:
-            # check that all vars are same length and convert to dict of lists
-            for v in self.meta.values():
-                ntasks = len(v.split())
-                break
-            meta_with_lists = {}
-            for k, v in self.meta.items():
-                as_list = v.split()
-                if len(as_list) != ntasks:
+            return None
+        levels = []
+        for level in self._meta_levels():
+            columns = [v.split() for v in level.values()]
+            for column in columns:
+                if len(column) != len(columns[0]):
                     raise ValueError('meta vars not all equal length')
-                meta_with_lists[k] = as_list
-            for ix in range(ntasks):
-                n = self.name
-                for key in meta_with_lists.keys():
-                    n = n.replace(f'#{key}#', meta_with_lists[key][ix])
-                if n not in self.task_names:
-                    self.task_names.add(n)
-                else:
-                    raise ValueError('meta variables must produce unique tasks')
+            levels.append(columns)
+        return levels
+
+    def _ntasks(self, columns=None):
+        if not hasattr(self, 'meta'):
+            return 1
+        if columns is None:
+            columns = self._meta_columns()
+        return prod(len(level[0]) for level in columns)
+
+    @staticmethod
+    def _meta_rows(columns):
+        ''' return iterator of tuples of meta variable values, one for each task
+            Nested metatasks give the product of the rows of each level '''
+        if len(columns) == 1:
+            return zip(*columns[0])
+        levels = [list(zip(*level)) for level in columns]
+        return (tuple(chain.from_iterable(rows)) for rows in product(*levels))
+
+    def _iter_names(self, columns=None):
+        ''' return iterator of task names, lazily expanding metatask names '''
+        if not hasattr(self, 'meta'):
+            return iter((self.name,))
+        if columns is None:
+            columns = self._meta_columns()
+        name_format = _name_format(self.name, self._meta_keys()).format
+        return starmap(name_format, self._meta_rows(columns))
+
+    def _members(self, columns=None):
+        ''' yield (task name, dict of meta variable values) for each task
+            A task that is not a metatask yields its name with an empty dict'''
+        if not hasattr(self, 'meta'):
+            yield self.name, {}
+            return
+        if columns is None:
+            columns = self._meta_columns()
+        keys = self._meta_keys()
+        name_format = _name_format(self.name, keys).format
+        for row in self._meta_rows(columns):
+            yield name_format(*row), dict(zip(keys, row))
 
     def _generate_xml(self):
+        ''' Return task's metadata as a Task rocoto XML element
+            The element is cached until a validated attribute of the task is reassigned '''
+        if self._xml_cache is None:
+            self._cache_xml()
+        return self._xml_cache[0]
+
+    def _xml(self):
+        ''' Return task's pretty printed XML, indented for placement within the workflow '''
+        if self._xml_cache is None:
+            self._cache_xml()
+        return self._xml_cache[1]
+
+    def _cache_xml(self):
+        E = self._build_xml()
+        self._xml_cache = (E, ''.join(_pretty_xml(E, indent='    ')))
+
+    def _build_xml(self):
         ''' Convert task's metadata into a Task rocoto XML element '''
         task_attrs = dict()
         task_attrs['name'] = self.name
@@ -446,23 +1526,197 @@ class Task:
                     elm_task.append(E)
                 elif isinstance(V, list):
                     elm_task.extend(V)
+                elif isinstance(V, tuple):
+                    # envars are held as tuples of (name, text, cyclestr)
+                    elm_task.extend(_envar_element(*envar) for envar in V)
                 else:
                     elm_task.append(to_element(V, Ename))
         if hasattr(self, 'meta'):
-            if hasattr(self, 'metatask_name'):
-                E_metatask = Element('metatask', name=self.metatask_name)
-            else:
-                E_metatask = Element('metatask')
-            for k, v in self.meta.items():
-                E = Element('var', name=k)
-                E.text = v
-                E_metatask.append(E)
-            E_metatask.append(elm_task)
-            elm_task = E_metatask
+            # nested metatasks are built from the innermost out
+            levels = self._meta_levels()
+            for ix in reversed(range(len(levels))):
+                if ix == 0 and hasattr(self, 'metatask_name'):
+                    E_metatask = Element('metatask', name=self.metatask_name)
+                else:
+                    E_metatask = Element('metatask')
+                for k, v in levels[ix].items():
+                    E = Element('var', name=k)
+                    E.text = v
+                    E_metatask.append(E)
+                E_metatask.append(elm_task)
+                elm_task = E_metatask
 
         return elm_task
 
 
+def _strongly_connected(nodes, edges, key=None):
+    ''' Return the strongly connected components of a directed graph (Tarjan's algorithm).
+        edges(node) returns the nodes that node has edges to; key(node) returns a hashable
+        identity for node. Each component is a list of nodes and components are ordered
+        such that each follows the components it has edges to.'''
+    if key is None:
+        def key(node):
+            return node
+    index = {}
+    lowlink = {}
+    stack = []
+    on_stack = set()
+    sccs = []
+    for root in nodes:
+        if key(root) in index:
+            continue
+        work = [(root, key(root), None)]
+        while work:
+            node, k, it = work[-1]
+            if it is None:
+                index[k] = lowlink[k] = len(index)
+                stack.append(node)
+                on_stack.add(k)
+                it = iter(edges(node))
+                work[-1] = (node, k, it)
+            for nxt in it:
+                nk = key(nxt)
+                if nk not in index:
+                    work.append((nxt, nk, None))
+                    break
+                elif nk in on_stack:
+                    lowlink[k] = min(lowlink[k], index[nk])
+            else:
+                work.pop()
+                if work:
+                    pk = work[-1][1]
+                    lowlink[pk] = min(lowlink[pk], lowlink[k])
+                if lowlink[k] == index[k]:
+                    scc = []
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(key(n))
+                        scc.append(n)
+                        if key(n) == k:
+                            break
+                    sccs.append(scc)
+    return sccs
+
+
+def _potentials(nodes, edges):
+    ''' Return the shortest path distance of each node from a source with an edge of
+        weight 0 to every node (Bellman-Ford), or None if the graph has a negative cycle.
+        edges maps each node to its (node, weight) edges.'''
+    distance = dict.fromkeys(nodes, 0)
+    for _ in nodes:
+        changed = False
+        for node in nodes:
+            for nxt, weight in edges[node]:
+                if distance[node] + weight < distance[nxt]:
+                    distance[nxt] = distance[node] + weight
+                    changed = True
+        if not changed:
+            return distance
+    return None
+
+
+def _zero_weight_cycles(nodes, edges):
+    ''' Return the groups of nodes of a directed graph joined by cycles of total weight
+        zero, in the order of _strongly_connected. edges(node) yields (node, weight) pairs.
+        Within a strongly connected component, the cycles of weight zero are the cycles
+        of the edges with reduced weight zero, unless it has both positive and negative
+        cycles, which are combined into a cycle of weight zero.'''
+    nodes = list(nodes)
+    edges = {node: list(edges(node)) for node in nodes}
+    cycles = []
+    for scc in _strongly_connected(nodes, lambda node: [nxt for nxt, _ in edges[node]]):
+        members = set(scc)
+        inner = {node: [(nxt, weight) for nxt, weight in edges[node] if nxt in members]
+                 for node in scc}
+        if len(scc) == 1 and not inner[scc[0]]:
+            continue
+        for sign in (1, -1):
+            signed = {node: [(nxt, sign * weight) for nxt, weight in inner[node]]
+                      for node in scc}
+            distance = _potentials(scc, signed)
+            if distance is not None:
+                break
+        else:
+            cycles.append(scc)
+            continue
+        tight = {node: [nxt for nxt, weight in signed[node]
+                        if distance[node] + weight == distance[nxt]]
+                 for node in scc}
+        cycles.extend(component for component in _strongly_connected(scc, tight.__getitem__)
+                      if len(component) > 1 or component[0] in tight[component[0]])
+    return cycles
+
+
+def _required_elements(elm):
+    ''' yield the same cycle taskdep and metataskdep elements of a dependency element
+        that must succeed for the dependency to be satisfied '''
+    if elm.tag == 'and':
+        for child in elm:
+            yield from _required_elements(child)
+    elif elm.tag in _ref_attr:
+        offset = elm.attrib.get('cycle_offset')
+        if offset is not None and _offset_seconds(offset) != 0:
+            return
+        if elm.attrib.get('state', 'succeeded').lower() != 'succeeded':
+            return
+        if 'threshold' in elm.attrib:
+            return
+        yield elm
+
+
+def _reachable(targets, edges):
+    ''' return the nodes reachable from the edges of targets, stopping early once all
+        targets are found '''
+    targets = set(targets)
+    found = set()
+    todo = [n for t in targets for n in edges(t)]
+    while todo and not targets <= found:
+        n = todo.pop()
+        if n not in found:
+            found.add(n)
+            todo.extend(edges(n))
+    return found
+
+
+def _without_elements(elm, remove):
+    ''' return elm without the elements whose id is in remove, which are found through
+        and elements only. An and left with one child is replaced by the child.
+        Unchanged elements are shared, not copied. None is returned if nothing is left'''
+    if id(elm) in remove:
+        return None
+    if elm.tag != 'and':
+        return elm
+    children = [E for E in (_without_elements(child, remove) for child in elm) if E is not None]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    if len(children) == len(elm) and all(a is b for a, b in zip(children, elm)):
+        return elm
+    E = Element(elm.tag, elm.attrib)
+    E.extend(children)
+    return E
+
+
+@lru_cache(maxsize=1024)
+def _name_format(name, keys):
+    ''' compile a name containing #key# for meta variables keys into a format string
+        taking the variable values in order of keys '''
+    if '#' not in name:
+        return name.replace('{', '{{').replace('}', '}}')
+    parts = re.split('#({})#'.format('|'.join(re.escape(k) for k in keys)), name)
+    return ''.join(part.replace('{', '{{').replace('}', '}}') if ix % 2 == 0
+                   else '{%d}' % keys.index(part) for ix, part in enumerate(parts))
+
+
+def _substitute_meta(s, values):
+    ''' replace #var# in s with the metatask variable values '''
+    if '#' in s:
+        for key, value in values.items():
+            s = s.replace(f'#{key}#', value)
+    return s
+
+
 def to_element(obj, name):
     if hasattr(obj, 'to_element'):
         return obj.to_element(name)
@@ -473,88 +1727,120 @@ def to_element(obj, name):
         return E
 
 
-class DataDep(Dependency):
+class _DeferredDep(Dependency):
+    ''' dependency whose element is made by _make_element when first needed, usually
+        when the task is written, and kept '''
+    _element = None
+
+    @property
+    def elm(self):
+        if self._element is None:
+            self._element = self._make_element()
+        return self._element
+
+
+class _OperatorDep(_DeferredDep):
+    ''' dependency of operator oper on the dependencies args '''
+    def __init__(self, oper, args):
+        self.oper = oper
+        self.args = tuple(args)
+        self.refs = tuple(chain.from_iterable(arg.refs for arg in args))
+
+    def _make_element(self):
+        E = Element(self.oper)
+        E.extend(arg.elm for arg in self.args)
+        return E
+
+
+class _LeafDep(_DeferredDep):
+    ''' dependency on a single condition held as an interned spec, the arguments of
+        _leaf_element; equal dependencies share the spec, each has its own element '''
+
+    def _make_element(self):
+        return _leaf_element(*self.spec)
+
+
+def _text_spec(text):
+    ''' return the (text, cyclestr) spec of str or Offset text for _leaf_element '''
+    if isinstance(text, Offset):
+        return text.value, (('offset', text.offset),)
+    return text, () if '@' in text else None
+
+
+class DataDep(_LeafDep):
     def __init__(self, data, age=None, minsize=None):
         if not isinstance(data, str) and not isinstance(data, Offset):
             raise TypeError(f'Expected data to be type str or Offset, but was {type(data)}')
-        E_attrs = {}
+        E_attrs = []
         if isinstance(age, str):
-            E_attrs['age'] = age
+            E_attrs.append(('age', age))
         if isinstance(minsize, str):
-            E_attrs['minsize'] = minsize
-        if isinstance(data, Offset):
-            E = data.to_element('datadep', **E_attrs)
-        else:
-            E = Element('datadep', E_attrs)
-            E.text = data
-            E = _cyclestr(E)
-        self.elm = E
+            E_attrs.append(('minsize', minsize))
+        self.spec = _intern(('datadep', tuple(E_attrs), *_text_spec(data)))
+        self.refs = ()
 
 
-class TaskDep(Dependency):
+class TaskDep(_LeafDep):
     def __init__(self, task, cycle_offset=None, state=None):
         if not isinstance(task, str):
             raise TypeError(f'Expected data to be type str, but was {type(task)}')
-        E_attrs = {}
-        E_attrs['task'] = task
+        E_attrs = [('task', task)]
         if isinstance(cycle_offset, str):
-            E_attrs['cycle_offset'] = cycle_offset
+            E_attrs.append(('cycle_offset', cycle_offset))
         if isinstance(state, str):
-            E_attrs['state'] = state
-        E = Element('taskdep', E_attrs)
-        self.elm = E
+            E_attrs.append(('state', state))
+        self.spec = _intern(('taskdep', tuple(E_attrs)))
+        self.refs = _intern((('taskdep', task, cycle_offset
+                              if isinstance(cycle_offset, str) else None),))
 
 
-class MetaTaskDep(Dependency):
+class MetaTaskDep(_LeafDep):
     def __init__(self, metatask, cycle_offset=None, state=None, threshold=None):
         if not isinstance(metatask, str):
             raise TypeError(f'Expected metatask to be type str, but was {type(metatask)}')
-        E_attrs = {}
-        E_attrs['metatask'] = metatask
+        E_attrs = [('metatask', metatask)]
         if isinstance(cycle_offset, str):
-            E_attrs['cycle_offset'] = cycle_offset
+            E_attrs.append(('cycle_offset', cycle_offset))
         if isinstance(state, str):
-            E_attrs['state'] = state
+            E_attrs.append(('state', state))
         if isinstance(threshold, str):
-            E_attrs['threshold'] = threshold
-        E = Element('metataskdep', E_attrs)
-        self.elm = E
+            E_attrs.append(('threshold', threshold))
+        self.spec = _intern(('metataskdep', tuple(E_attrs)))
+        self.refs = _intern((('metataskdep', metatask, cycle_offset
+                              if isinstance(cycle_offset, str) else None),))
 
 
-class TimeDep(Dependency):
+class TimeDep(_LeafDep):
     def __init__(self, time):
         if not isinstance(time, str) and not isinstance(time, Offset):
             raise TypeError(f'Expected time to be type str or Offset, but was {type(time)}')
-        if isinstance(time, Offset):
-            E = time.to_element('timedep')
-        else:
-            E = Element('timedep')
-            E.text = time
-            E = _cyclestr(E)
-        self.elm = E
+        self.spec = _intern(('timedep', (), *_text_spec(time)))
+        self.refs = ()
 
 
-class TagDep(Dependency):
+class TagDep(_LeafDep):
     ''' provide mechanism for user to specify the tag 'sh' or 'rb'
         and the text for the tag; User must provide cyclstr tags in text if they need them '''
     def __init__(self, tag, text):
-        E = Element(tag)
-        E.text = text
-        self.elm = E
+        self.spec = _intern((tag, (), text))
+        self.refs = ()
 
 
 def product_meta(dict_in):
+    ''' Return meta dict holding every combination of the values of dict_in
+        Values may be space separated strings or iterables of values.
+        The var lists of the metatask grow with the product of the number of values;
+        a list of meta dicts makes nested metatasks with the same task names instead.'''
     if not isinstance(dict_in, dict):
         raise TypeError(f'Expected dict, but got {type(dict_in)}')
+    values = [v.split() if isinstance(v, str) else [str(x) for x in v]
+              for v in dict_in.values()]
+    sizes = [len(v) for v in values]
     new_dict = {}
-    keys = [k for k in dict_in.keys()]
-    values_as_list_of_lists = [v.split(' ') for v in dict_in.values()]
-    prodicized = product(*values_as_list_of_lists)
-    combinations_list_of_lists = [list(i) for i in prodicized]
-    new_values_as_list_of_lists = [list(x) for x in zip(*combinations_list_of_lists)]  # reshape
-    new_values_as_list = [" ".join(x) for x in new_values_as_list_of_lists]
-
-    for k, v in zip(keys, new_values_as_list):
-        new_dict[k] = v
-
+    # each value repeats once per combination of the following keys' values and
+    # that block repeats once per combination of the preceding keys' values
+    for ix, k in enumerate(dict_in):
+        inner = prod(sizes[ix + 1:])
+        block = ' '.join(x for x in values[ix] for _ in range(inner))
+        new_dict[k] = ' '.join(repeat(block, prod(sizes[:ix])))
     return new_dict
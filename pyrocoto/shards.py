@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+''' Split a workflow into independent workflows, each written to its own xml so that rocoto
+    handles a smaller workflow on each run.'''
+import copy
+import os
+from xml.etree.ElementTree import Element
+from .pyrocoto import (Workflow, Task, Dependency, DataDep, TaskDep, MetaTaskDep, Offset,
+                       _ref_attr, _report, _substitute_meta)
+
+__all__ = ['Partition', 'partition']
+
+
+class Partition:
+    ''' Result of partition
+        workflows: dict of shard key to its Workflow
+        cross_dependencies: list of (task name, shard, tag, name, cycle_offset, upstream
+            shards, sentinel file) for each taskdep or metataskdep of a task on another
+            shard, which was replaced by a datadep on the sentinel file. Sentinel tasks in
+            the upstream shards create the file when the dependency is met.'''
+    def __init__(self):
+        self.workflows = {}
+        self.cross_dependencies = []
+
+    def __repr__(self):
+        tasks = {key: len(flow.tasks) for key, flow in self.workflows.items()}
+        return f'Partition(tasks={tasks!r}, cross_dependencies={len(self.cross_dependencies)})'
+
+    def write(self, directory, **kwargs):
+        ''' Write each shard's workflow to directory/<shard>.xml with write_xml(**kwargs)
+            Return dict of shard key to (xml path, database path) of the shards; each shard
+            is run with its own database, rocotorun -w <xml path> -d <database path>.'''
+        directory = os.path.expanduser(directory)
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for key, flow in self.workflows.items():
+            xmlfile = os.path.join(directory, f'{key}.xml')
+            flow.write_xml(xmlfile, **kwargs)
+            paths[key] = (xmlfile, os.path.join(directory, f'{key}.db'))
+        return paths
+
+
+def _components(flow, owner):
+    ''' return the weakly connected component of each task by taskdep/metataskdep '''
+    parent = list(range(len(flow.tasks)))
+
+    def find(ix):
+        while parent[ix] != ix:
+            parent[ix] = parent[parent[ix]]
+            ix = parent[ix]
+        return ix
+
+    for ix, task in enumerate(flow.tasks):
+        for name in task._iter_names():
+            for tag, n, _ in flow._upstream.get(name, ()):
+                parent[find(owner[tag, n])] = find(ix)
+    roots = {}
+    return [f'component{roots.setdefault(find(ix), len(roots))}'
+            for ix in range(len(flow.tasks))]
+
+
+def _keys(flow, by, owner):
+    if by == 'component':
+        return _components(flow, owner)
+    if by == 'cycledef':
+        return ['_'.join(task.cycledefs) for task in flow.tasks]
+    if not callable(by):
+        raise ValueError(f"Expected by to be 'component', 'cycledef' or a function, but got "
+                         f'{by!r}')
+    keys = [by(task) for task in flow.tasks]
+    for task, key in zip(flow.tasks, keys):
+        if not isinstance(key, str) or not key:
+            raise TypeError(f'Expected the shard key of task {task.name!r} to be a non-empty '
+                            f'str, but got {key!r}')
+    return keys
+
+
+def _sentinel_stem(tag, name, state, threshold):
+    ''' name of the sentinel of a dependency, also for names with metatask variables
+        The tag is included, name_task or name_metatask, as tasks and metatasks of the
+        same name are different dependencies.'''
+    stem = f"{name}_{tag[:-len('dep')]}"
+    if state is None and threshold is None:
+        return stem
+    return '_'.join([stem, (state or 'succeeded').lower()] + [threshold] * bool(threshold))
+
+
+def _shard_log(flow, key):
+    ''' return the log element of shard key, the workflow's log in a directory key '''
+    if flow.log_element is None:
+        return None
+    E = copy.deepcopy(flow.log_element)
+    node = E if len(E) == 0 else E[0]
+    if len(E) > 1 or node is not E and (E.text or node.tail) or not node.text:
+        raise ValueError("The workflow's log can not be split into a log per shard; pass "
+                         "partition log='...{shard}...', a log path with a {shard} field")
+    node.text = os.path.join(os.path.dirname(node.text), key, os.path.basename(node.text))
+    return E
+
+
+def partition(flow, by='component', sentinel_dir='sentinels', log=None):
+    ''' Return a Partition splitting workflow flow into independent workflows (shards)
+        by 'component', the weakly connected components of the task dependencies, by
+        'cycledef', the cycle definition groups of the tasks, or by a function returning
+        the shard key (str) of a task. Metatasks are not split.
+        A dependency on a task or metatask of another shard is replaced by a datadep on a
+        sentinel file in sentinel_dir, created by a sentinel task added to the upstream
+        shard. Shards log to log formatted with shard, by default the workflow's log in a
+        subdirectory named by the shard. The workflow is not modified.'''
+    errors = flow.validate()
+    if errors:
+        raise ValueError(_report(errors, 'in workflow'))
+    owner = {}  # (tag, name) -> index of the task
+    for ix, task in enumerate(flow.tasks):
+        owner.update((('taskdep', name), ix) for name in task._iter_names())
+        if hasattr(task, 'metatask_name'):
+            owner['metataskdep', task.metatask_name] = ix
+    keys = _keys(flow, by, owner)
+    result = Partition()
+    shard_tasks = {key: [] for key in keys}
+    sentinels = {}  # (tag, name, state, threshold) -> sentinel task
+    stems = {}  # sentinel stem -> spec
+
+    def sentinel(tag, name, state, threshold):
+        spec = (tag, name, state, threshold)
+        if spec not in sentinels:
+            up = flow.tasks[owner[tag, name]]
+            stem = _sentinel_stem(tag, name, state, threshold)
+            if stems.setdefault(stem, spec) != spec or f'{stem}_sentinel' in flow.task_names:
+                raise ValueError(f'Sentinel task {stem + "_sentinel"!r} of the {tag} on '
+                                 f'{name!r} clashes with a task of the workflow or another '
+                                 f'sentinel; rename the task')
+            path = os.path.join(sentinel_dir, f'{stem}.@Y@m@d@H@M')
+            d = {'name': f'{stem}_sentinel', 'cycledefs': up.cycledefs, 'cores': '1',
+                 'command': f'mkdir -p {sentinel_dir} && touch {path}',
+                 'join': f'{path}.join', 'walltime': '00:05:00',
+                 'queue': up.queue, 'account': up.account,
+                 'dependency': TaskDep(name, state=state) if tag == 'taskdep' else
+                 MetaTaskDep(name, state=state, threshold=threshold)}
+            if hasattr(up, 'partition'):
+                d['partition'] = up.partition
+            sentinels[spec] = Task(d)
+            shard_tasks[keys[owner[tag, name]]].append(sentinels[spec])
+
+    def rewrite(E, task, key, members):
+        ''' return E with its dependencies on other shards replaced by datadeps '''
+        if E.tag in _ref_attr:
+            name = E.get(_ref_attr[E.tag])
+            state, threshold = E.get('state'), E.get('threshold')
+            names = {_substitute_meta(name, meta) for _, meta in members}
+            shards = {keys[owner[E.tag, n]] for n in names}
+            if shards == {key}:
+                return E
+            for n in names:
+                sentinel(E.tag, n, state, threshold)
+            path = os.path.join(sentinel_dir,
+                                f'{_sentinel_stem(E.tag, name, state, threshold)}.@Y@m@d@H@M')
+            offset = E.get('cycle_offset')
+            result.cross_dependencies.append((task.name, key, E.tag, name, offset,
+                                              sorted(shards), path))
+            return DataDep(path if offset is None else Offset(path, offset)).elm
+        children = [rewrite(child, task, key, members) for child in E]
+        if all(a is b for a, b in zip(children, E)):
+            return E
+        new = Element(E.tag, E.attrib)
+        new.text = E.text
+        new.extend(children)
+        return new
+
+    for task, key in zip(flow.tasks, keys):
+        if hasattr(task, 'dependency'):
+            elm = task.dependency.elm
+            new = rewrite(elm, task, key, list(task._members()))
+            if new is not elm:
+                task = copy.copy(task)
+                task.dependency = Dependency(new)
+        shard_tasks[key].append(task)
+
+    for key, tasks in shard_tasks.items():
+        shard = Workflow(_shared=False, **flow.workflow_element.attrib)
+        for task in tasks:
+            for group in task.cycledefs:
+                shard.cycle_definitions.setdefault(group, flow.cycle_definitions[group])
+        if log is None:
+            shard.log_element = _shard_log(flow, key)
+        else:
+            shard.set_log(log.format(shard=key))
+        shard.add_tasks(tasks)
+        result.workflows[key] = shard
+    return result
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+''' Dry-run a workflow over a range of cycles to estimate concurrency and resource demand.
+    Requires numpy to expand cycles.'''
+import heapq
+from collections import deque
+from datetime import datetime, timedelta
+from .cycles import _offset_seconds, expand_cycles, expand_cyclestr, np
+from .pyrocoto import _simplify, _substitute_meta
+
+__all__ = ['SimulationReport', 'simulate']
+
+_epoch = datetime(1970, 1, 1)
+
+
+def _to_datetime(seconds):
+    return _epoch + timedelta(seconds=int(seconds))
+
+
+def _task_cores(task):
+    ''' number of cores requested by task from cores or nodes (N:ppn=M+...) '''
+    if hasattr(task, 'cores'):
+        return int(task.cores)
+    cores = 0
+    for spec in task.nodes.split('+'):
+        nodes, *options = spec.split(':')
+        ppn = 1
+        for option in options:
+            if option.startswith('ppn='):
+                ppn = int(option[4:])
+        cores += int(nodes) * ppn
+    return cores
+
+
+def _compile(elm, meta):
+    ''' compile a dependency element into nested tuples for evaluation
+        Leaves that cannot be simulated (datadep, sh, rb) compile to ('true',)'''
+    tag = elm.tag
+    if tag in ('and', 'or', 'not', 'nand', 'nor', 'xor', 'some'):
+        threshold = float(elm.attrib.get('threshold', 1))
+        return (tag, tuple(_compile(child, meta) for child in elm), threshold)
+    if tag in ('taskdep', 'metataskdep'):
+        name = elm.attrib['task' if tag == 'taskdep' else 'metatask']
+        offset = _offset_seconds(elm.attrib.get('cycle_offset', '0'))
+        state = elm.attrib.get('state', 'succeeded').lower()
+        threshold = float(elm.attrib.get('threshold', 1))
+        return (tag, _substitute_meta(name, meta), offset, state, threshold)
+    if tag == 'timedep':
+        if len(elm) and elm[0].tag == 'cyclestr':
+            return (tag, elm[0].text, elm[0].attrib.get('offset'))
+        return (tag, elm.text, None)
+    return ('true',)
+
+
+class SimulationReport:
+    ''' Result of simulate
+        peak_jobs: largest number of jobs running at once
+        peak_cores: dict of queue to the largest number of cores in use at once
+        cycle_latency: dict of cycle time to seconds from cycle time to its completion,
+            None for cycles that did not complete
+        expired: cycle times that expired (cyclelifespan) before completing
+        blocked: dict of cycle time to names of tasks that never ran
+        jobs: number of jobs run'''
+    def __init__(self):
+        self.peak_jobs = 0
+        self.peak_cores = {}
+        self.cycle_latency = {}
+        self.expired = []
+        self.blocked = {}
+        self.jobs = 0
+
+    def __repr__(self):
+        completed = [v for v in self.cycle_latency.values() if v is not None]
+        latency = max(completed) if completed else None
+        return (f'SimulationReport(jobs={self.jobs}, peak_jobs={self.peak_jobs}, '
+                f'peak_cores={self.peak_cores!r}, cycles={len(self.cycle_latency)}, '
+                f'completed={len(completed)}, max_latency={latency}, '
+                f'expired={len(self.expired)})')
+
+
+class _Simulation:
+    def __init__(self, flow, start, end, interval):
+        attrib = flow.workflow_element.attrib
+        self.realtime = attrib.get('realtime', 'F').upper() in ('T', 'TRUE', 'Y', 'YES')
+        self.taskthrottle = int(attrib.get('taskthrottle', 0)) or None
+        self.cyclethrottle = int(attrib.get('cyclethrottle', 1))
+        lifespan = attrib.get('cyclelifespan')
+        self.lifespan = None if lifespan is None else _offset_seconds(lifespan)
+        self.interval = interval
+        self.report = SimulationReport()
+
+        # cycle times (seconds) of each group and when they activate
+        self.activation = {}
+        groups = {}
+        for group, cycles in _expand(flow, start, end).items():
+            groups[group] = set(cycles.tolist())
+            cycledef = flow.cycle_definitions[group]
+            offset = (0 if cycledef.activation_offset == 'None'
+                      else _offset_seconds(cycledef.activation_offset))
+            for cycle in groups[group]:
+                self.activation[cycle] = min(self.activation.get(cycle, cycle + offset),
+                                             cycle + offset)
+        self.pending_cycles = deque(sorted(self.activation))
+
+        # expanded tasks: (name, task, compiled dependency, cores, walltime, cycle sets)
+        self.members = []
+        self.metatasks = {}
+        for task in flow.tasks:
+            metatask = getattr(task, 'metatask_name', None)
+            for name, meta in task._members():
+                if hasattr(task, 'dependency'):
+                    dependency = _compile(_simplify(task.dependency.elm), meta)
+                else:
+                    dependency = ('true',)
+                groups_of_task = [groups[g] for g in task.cycledefs if g in groups]
+                self.members.append((name, task, dependency, _task_cores(task),
+                                     _offset_seconds(task.walltime), groups_of_task))
+                if metatask is not None:
+                    self.metatasks.setdefault(metatask, []).append(name)
+        self.first_cycle = self.pending_cycles[0] if self.pending_cycles else None
+        self.last_cycle = self.pending_cycles[-1] if self.pending_cycles else None
+
+        self.done = set()  # (name, cycle) of completed jobs
+        self.active = {}  # cycle -> list of members not yet submitted
+        self.running = {}  # cycle -> number of jobs running
+        self.jobs = []  # heap of (end time, name, cycle, queue, cores, final)
+        self.cores = {}  # queue -> cores in use
+        self.wakeup = None  # earliest time a waiting timedep will be met
+        self.activated = {}  # cycle -> time the cycle was activated
+
+    def satisfied(self, dep, cycle, now):
+        kind = dep[0]
+        if kind == 'true':
+            return True
+        if kind in ('taskdep', 'metataskdep'):
+            _, name, offset, state, threshold = dep
+            target = cycle + offset
+            if target < self.first_cycle or target > self.last_cycle:
+                return True  # outside the simulated cycles, assume it is complete
+            if state != 'succeeded':
+                return False  # failures are not simulated
+            if kind == 'taskdep':
+                return (name, target) in self.done
+            members = self.metatasks.get(name, [])
+            count = sum((m, target) in self.done for m in members)
+            return bool(members) and count >= threshold * len(members)
+        if kind == 'timedep':
+            _, template, offset = dep
+            text = expand_cyclestr(template, _to_datetime(cycle), offset)
+            try:
+                time = (datetime.strptime(text, '%Y%m%d%H%M%S') - _epoch) // timedelta(seconds=1)
+            except ValueError:
+                return True
+            if now < time:
+                self.wakeup = time if self.wakeup is None else min(self.wakeup, time)
+                return False
+            return True
+        _, deps, threshold = dep
+        values = [self.satisfied(d, cycle, now) for d in deps]
+        if kind == 'and':
+            return all(values)
+        if kind == 'or':
+            return any(values)
+        if kind == 'not':
+            return not values[0]
+        if kind == 'nand':
+            return not all(values)
+        if kind == 'nor':
+            return not any(values)
+        if kind == 'xor':
+            return sum(values) == 1
+        return sum(values) >= threshold * len(values)  # some
+
+    def activate(self, now):
+        while self.pending_cycles:
+            cycle = self.pending_cycles[0]
+            if self.realtime and self.activation[cycle] > now:
+                break
+            if len(self.active) >= self.cyclethrottle:
+                break
+            self.pending_cycles.popleft()
+            members = [m for m in self.members if any(cycle in g for g in m[5])]
+            self.active[cycle] = members
+            self.running[cycle] = 0
+            self.activated[cycle] = now
+            self.report.cycle_latency[_to_datetime(cycle)] = None
+
+    def complete(self, cycle, now):
+        del self.active[cycle]
+        del self.running[cycle]
+        self.report.cycle_latency[_to_datetime(cycle)] = now - cycle
+
+    def expire(self, now):
+        if self.lifespan is None:
+            return
+        for cycle in list(self.active):
+            if now >= self.activated[cycle] + self.lifespan:
+                self.report.expired.append(_to_datetime(cycle))
+                if self.active[cycle]:
+                    self.report.blocked[_to_datetime(cycle)] = [m[0] for m in self.active[cycle]]
+                del self.active[cycle]
+                del self.running[cycle]
+
+    def submit(self, now):
+        self.wakeup = None
+        for cycle in sorted(self.active):
+            waiting = []
+            for member in self.active[cycle]:
+                name, task, dependency, cores, walltime, _ = member
+                if (self.taskthrottle is not None and len(self.jobs) >= self.taskthrottle or
+                        not self.satisfied(dependency, cycle, now)):
+                    waiting.append(member)
+                    continue
+                final = getattr(task, 'final', 'false') == 'true'
+                heapq.heappush(self.jobs, (now + max(walltime, 1), name, cycle, task.queue,
+                                           cores, final))
+                self.cores[task.queue] = self.cores.get(task.queue, 0) + cores
+                self.running[cycle] += 1
+                self.report.jobs += 1
+            self.active[cycle] = waiting
+        report = self.report
+        report.peak_jobs = max(report.peak_jobs, len(self.jobs))
+        for queue, cores in self.cores.items():
+            report.peak_cores[queue] = max(report.peak_cores.get(queue, 0), cores)
+
+    def finish(self, now):
+        while self.jobs and self.jobs[0][0] <= now:
+            _, name, cycle, queue, cores, final = heapq.heappop(self.jobs)
+            self.cores[queue] -= cores
+            self.done.add((name, cycle))
+            if cycle not in self.running:
+                continue  # cycle expired or already completed by a final task
+            self.running[cycle] -= 1
+            if final:
+                self.active[cycle] = []
+            if not self.active[cycle] and not self.running[cycle]:
+                self.complete(cycle, now)
+
+    def next_event(self, now):
+        times = []
+        if self.jobs:
+            times.append(self.jobs[0][0])
+        if self.pending_cycles and self.realtime:
+            # a cycle due now is held by cyclethrottle until another event
+            activation = self.activation[self.pending_cycles[0]]
+            if activation > now:
+                times.append(activation)
+        if self.lifespan is not None and self.active:
+            times.append(min(self.activated[c] + self.lifespan for c in self.active))
+        if self.wakeup is not None:
+            times.append(self.wakeup)
+        if not times:
+            return None
+        time = min(times)
+        if self.interval is not None:
+            time = now + -(-(time - now) // self.interval) * self.interval
+        return time
+
+    def run(self):
+        if self.first_cycle is None:
+            return self.report
+        now = min(self.activation.values()) if self.realtime else self.first_cycle
+        while True:
+            self.finish(now)
+            self.expire(now)
+            self.activate(now)
+            # cycles with nothing to run are complete as soon as they activate
+            for cycle in [c for c in self.active if not self.active[c] and not self.running[c]]:
+                self.complete(cycle, now)
+            self.activate(now)
+            self.submit(now)
+            now_next = self.next_event(now)
+            if now_next is None:
+                break
+            now = now_next
+        for cycle, members in self.active.items():
+            if members:
+                self.report.blocked[_to_datetime(cycle)] = [m[0] for m in members]
+        return self.report
+
+
+def _expand(flow, start, end):
+    ''' return dict of group to cycle times as seconds since 1970 '''
+    return {group: cycles.astype('M8[s]').astype(np.int64)
+            for group, cycles in expand_cycles(flow.cycle_definitions, start, end).items()}
+
+
+def simulate(flow, start, end, interval=None):
+    ''' Simulate running workflow flow for the cycles from start to end inclusive.
+        Each job runs for its walltime as soon as its TaskDep/MetaTaskDep (with cycle_offset)
+        and TimeDep dependencies are met; other dependencies are taken as met and failures
+        are not simulated. Dependencies on cycles outside start to end are taken as met.
+        The workflow's realtime, taskthrottle, cyclethrottle (default 1) and cyclelifespan
+        attributes are honored, and in realtime mode cycles activate at their cycle time
+        plus activation_offset. With interval (seconds) jobs are only submitted every
+        interval seconds, as when rocotorun runs from cron.
+        Return a SimulationReport.'''
+    flow._require_valid()
+    return _Simulation(flow, start, end, interval).run()
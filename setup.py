@@ -11,6 +11,8 @@ setup(
     description="Python API for creating validated rocoto xml definitions",
     long_description=readme,
     include_package_data=True,
+    extras_require={'cycles': ['numpy']},
+    entry_points={'console_scripts': ['pyrocoto = pyrocoto.cli:main']},
     author="Adam Schnapp",
     author_email="adschnapp@gmail.com",
     url=url,
@@ -0,0 +1,14 @@
+''' objects shared by the test modules, imported as a plain module '''
+from pyrocoto import Task
+
+
+def make_task(name, dependency=None, **kwargs):
+    ''' return a valid Task named name, kwargs set or override its other attributes '''
+    d = {'name': name, 'cycledefs': 'hourly', 'command': f'/run {name}',
+         'join': f'/{name}.join', 'queue': 'queue', 'account': 'acct'}
+    if dependency is not None:
+        d['dependency'] = dependency
+    d.update(kwargs)
+    if 'nodes' not in d:
+        d.setdefault('cores', '1')
+    return Task(d)
@@ -0,0 +1,186 @@
+import os
+import pytest
+import threading
+import time
+from io import StringIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pyrocoto import (Workflow, TaskDep, MetaTaskDep, workflow_namespace,
+                      clear_namespace)
+from factories import make_task
+
+
+# builders run on a process pool must be importable
+def prep():
+    return make_task('prep')
+
+
+def post(station):
+    time.sleep(0.01)  # builders finish out of order
+    return make_task(f'post_{station}_#lead#', metatask_name=f'post_{station}',
+                     meta={'lead': '000 003 006'}, dependency=TaskDep('prep'))
+
+
+def post_kbos():
+    return post('kbos')
+
+
+def post_kjfk():
+    return post('kjfk')
+
+
+def post_kord():
+    return post('kord')
+
+
+def archive():
+    return make_task('archive', dependency=MetaTaskDep('post_kord'))
+
+
+builders = [prep, post_kbos, post_kjfk, post_kord, archive]
+
+
+def make_flow(defer):
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.set_log('log.@Y@m@d@H')
+    for func in builders:
+        assert flow.task(defer=defer)(func) is (func if defer else None)
+    return flow
+
+
+def xml(flow):
+    f = StringIO()
+    flow.write_xml(f)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('executor', [None, 'thread', 'process'])
+def test_build_same_as_serial(executor):
+    serial = make_flow(defer=False)
+    flow = make_flow(defer=True)
+    assert flow.tasks == []
+    tasks = flow.build(executor=executor, max_workers=4)
+    assert [t.name for t in tasks] == [t.name for t in serial.tasks]
+    assert xml(flow) == xml(serial)
+    assert flow.build() == []  # registered functions are only built once
+
+
+def test_build_errors_keep_builders():
+    flow = make_flow(defer=True)
+    flow.task(defer=True)(prep)
+    with pytest.raises(ValueError, match="Error adding task 'prep'"):
+        flow.build()
+    assert flow.tasks == []
+    assert flow._builders == builders + [prep]
+    with pytest.raises(ValueError, match='executor'):
+        flow.build(executor='fork')
+
+
+def forgot_return():
+    make_task('forgot')
+
+
+def test_build_fixed_and_retried():
+    flow = make_flow(defer=True)
+    flow.task(defer=True)(forgot_return)
+    with pytest.raises(ValueError, match="task #5: Expected a Task, but got <class 'NoneType'>"):
+        flow.build(executor=None)
+    assert flow.tasks == [] and flow.task_names == set()
+    flow._builders.remove(forgot_return)
+    assert [task.name for task in flow.build()] == [func().name for func in builders]
+
+
+def test_concurrent_add_task():
+    flow = make_flow(defer=True)
+
+    def add(i):
+        for j in range(50):
+            flow.add_task(make_task(f't{i}_{j}'))
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(flow.tasks) == len(flow.task_names) == 400
+
+
+def test_build_cache(tmpdir, monkeypatch):
+    cache = str(tmpdir.join('flow.cache'))
+    config = tmpdir.join('config')
+    config.write('a')
+    built = make_flow(defer=True)
+    tasks = built.build(executor=None, cache=cache, inputs=[str(config)])
+
+    def fail(*args, **kwargs):
+        raise AssertionError('builder called for a cached build')
+    with monkeypatch.context() as m:
+        m.setattr(f'{__name__}.make_task', fail)
+        flow = make_flow(defer=True)
+        loaded = flow.build(cache=cache, inputs=[str(config)])
+    assert [t.name for t in loaded] == [t.name for t in tasks]
+    assert flow._builders == [] and xml(flow) == xml(built)
+    flow.add_task(make_task('more'))  # a loaded workflow is built on as usual
+
+    config.write('b')
+    flow = make_flow(defer=True)
+    with pytest.raises(ValueError, match="Error adding task 'prep'"):
+        flow.task(defer=True)(prep)
+        flow.build(executor=None, cache=cache, inputs=[str(config)])
+
+
+def test_build_cache_deferred_validation(tmpdir):
+    cache = str(tmpdir.join('flow.cache'))
+
+    def make():
+        flow = Workflow(_shared=False, defer_validation=True)
+        flow.define_cycle('hourly', '0 * * * * *')
+        for func in builders:
+            flow.task(defer=True)(func)
+        return flow
+    built, loaded = make(), make()
+    tasks = built.build(executor=None, cache=cache)
+    # the loaded tasks await validation as the built ones do
+    assert [t.name for t in loaded.build(cache=cache)] == [t.name for t in tasks]
+    assert loaded.tasks == [] and len(loaded._unvalidated) == len(builders)
+    assert loaded.validate() == [] and xml(loaded) == xml(built)
+
+
+def test_build_cache_key_covers_pyrocoto(monkeypatch):
+    import pyrocoto.pyrocoto as module
+    read = []
+
+    def recording_open(path, *args, **kwargs):
+        read.append(os.path.basename(path))
+        return open(path, *args, **kwargs)
+    monkeypatch.setattr(module, 'open', recording_open, raising=False)
+    module._snapshot_key([prep], [])
+    assert {'pyrocoto.py', 'helpers.py', 'cycles.py', 'loader.py', 'shards.py',
+            'test_build.py'} <= set(read)
+
+
+def define_region(region):
+    # as in a definition module, tasks are added to the shared workflow
+    flow = Workflow()
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.add_task(make_task(f'prep_{region}'))
+    flow.add_task(make_task('post', dependency=TaskDep(f'prep_{region}')))
+
+
+def write_region(region):
+    with workflow_namespace(region) as namespace:
+        define_region(region)
+    flow = Workflow(namespace=namespace)
+    assert Workflow(namespace=region).tasks is flow.tasks
+    clear_namespace(region)
+    return xml(flow)
+
+
+@pytest.mark.parametrize('pool_class', [ThreadPoolExecutor, ProcessPoolExecutor])
+def test_workflow_namespaces(pool_class):
+    shared = list(Workflow().tasks)
+    regions = [f'region{i}' for i in range(12)]
+    with pool_class(4) as pool:
+        written = list(pool.map(write_region, regions))
+    assert written == [write_region(region) for region in regions]
+    assert 'prep_region3' in written[3] and 'prep_region4' not in written[3]
+    assert Workflow().tasks == shared
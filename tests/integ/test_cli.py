@@ -0,0 +1,62 @@
+import sys
+import pytest
+from pyrocoto.cli import main
+
+suite = '''
+from pyrocoto import Workflow, Task
+flow = Workflow()
+flow.define_cycle('hourly', '0 * * * * *')
+for name in {names!r}:
+    flow.add_task(Task({{'name': name, 'cycledefs': 'hourly', 'command': '/run',
+                        'cores': '1', 'join': '/j', 'queue': 'q', 'account': 'a'}}))
+'''
+
+
+@pytest.fixture(autouse=True)
+def restore_sys_path(monkeypatch):
+    # main adds the current directory to sys.path, as python -m does
+    monkeypatch.setattr(sys, 'path', list(sys.path))
+
+
+def test_cli_build(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('east.py').write(suite.format(names=['e1', 'e2']))
+    tmpdir.join('west.py').write(suite.format(names=['w1']))
+    assert main(['build', 'east', 'west.py:flow', '-o', 'xml']) == 0
+    assert capsys.readouterr().out.splitlines() == [
+        'xml/east.xml: 2 added, 0 changed, 0 removed',
+        'xml/west.xml: 1 added, 0 changed, 0 removed']
+    assert tmpdir.join('xml', 'east.xml').read().count('<task ') == 2
+
+    tmpdir.join('west.py').write(suite.format(names=['w1', 'w2']))
+    assert main(['build', 'east', 'west.py', '-o', 'xml']) == 0
+    assert capsys.readouterr().out.splitlines() == [
+        'xml/east.xml: up to date',
+        'xml/west.xml: 1 added, 0 changed, 0 removed']
+    # modules are built independently though their workflows are shared
+    assert tmpdir.join('xml', 'west.xml').read().count('<task ') == 2
+
+    assert main(['build', 'east=one.xml', 'missing', '-j', '2']) == 1
+    out, err = capsys.readouterr()
+    assert out == 'one.xml: 2 added, 0 changed, 0 removed\n'
+    assert err.startswith("missing: ModuleNotFoundError: No module named 'missing'")
+
+
+def test_cli_build_workflow_options(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('slurm.py').write(suite.replace(
+        'Workflow()', "Workflow(scheduler='slurm', realtime='F', defer_validation=True)"
+    ).format(names=['s1']))
+    assert main(['build', 'slurm.py', '-o', 'slurm.xml']) == 0
+    xml = tmpdir.join('slurm.xml').read()
+    assert 'scheduler="slurm"' in xml and 'realtime="F"' in xml
+    assert xml.count('<task ') == 1
+
+
+def test_cli_build_file_named_as_module(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join('json.py').write(suite.format(names=['j1']))
+    tmpdir.join('after.py').write('import json\njson.dumps({})\n' + suite.format(names=['a1']))
+    assert main(['build', 'json.py', 'after.py', '-o', 'xml']) == 0
+    assert tmpdir.join('xml', 'json.xml').read().count('<task ') == 1
+    assert tmpdir.join('xml', 'after.xml').read().count('<task ') == 1
@@ -118,3 +118,15 @@ def test_shared_workflow(data_dir, request):
     validationfile = f'{wf_name}.validate'
     with open(validationfile) as f, open(wf_file) as f2:
         assert  f.read() == f2.read()
+
+
+def test_mytask_validated_attributes():
+    task = MySerialTask({'name': 'a', 'walltime': '00:20:00', 'extra': 'not validated'})
+    assert task.walltime == '00:20:00'
+    assert task.maxtries == '2'  # default not set by MySerialTask
+    assert task.extra == 'not validated'
+    assert task._validated == {'_account', '_cores', '_memory', '_queue', '_walltime',
+                               '_maxtries', '_final', '_name'}
+    assert '_name' not in vars(task)  # validated data is held in slots
+    with pytest.raises(TypeError):
+        task.queue = 1
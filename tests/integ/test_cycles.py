@@ -0,0 +1,48 @@
+import pytest
+from datetime import datetime
+from pyrocoto import Workflow, CycleDefinition, Offset, expand_cycles, expand_cyclestr
+
+np = pytest.importorskip('numpy')
+
+
+def test_invalid_definitions():
+    for definition in ['0 * * *', '61 * * * * *', '0 * * 13 * *', '*/0 * * * * *',
+                       '202401010000 202401020000 1:30', '2024 202401020000 01:00:00']:
+        with pytest.raises(ValueError):
+            CycleDefinition('bad', definition)
+
+
+def test_cron_cycles():
+    weekday_mornings = CycleDefinition('weekday', '30 6,18 * * * 1-5')
+    cycles = weekday_mornings.cycles('202401050000', datetime(2024, 1, 8, 6, 30))
+    assert cycles.tolist() == [datetime(2024, 1, 5, 6, 30), datetime(2024, 1, 5, 18, 30),
+                               datetime(2024, 1, 8, 6, 30)]
+    every5 = CycleDefinition('every5', '*/5 * * * * *')
+    assert len(every5.cycles('202401010000', '202412312355')) == 366 * 24 * 12
+    leap_days = CycleDefinition('leap', '0 0 29 2 2020-2030 *')
+    assert [c.year for c in leap_days.cycles('201901010000', '203101010000').tolist()] == \
+        [2020, 2024, 2028]
+
+
+def test_expand_workflow_cycles():
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.define_cycle('6hourly', '202401010000 202401310000 06:00:00')
+    cycles = expand_cycles(flow.cycle_definitions, '202401010300', '202401011200')
+    assert len(cycles['hourly']) == 10
+    assert cycles['6hourly'].astype(str).tolist() == ['2024-01-01T06:00', '2024-01-01T12:00']
+    assert len(np.union1d(cycles['hourly'], cycles['6hourly'])) == 10
+
+
+def test_expand_cyclestr():
+    assert expand_cyclestr('/com/@Y@m@d/t@Hz', '202401010600') == '/com/20240101/t06z'
+    assert expand_cyclestr(Offset('@Y@m@d@H', '-24:00:00'), datetime(2024, 3, 1)) == \
+        '2024022900'
+    cycles = CycleDefinition('6hourly', '0 */6 * * * *').cycles('202312311200',
+                                                                '202401010600')
+    assert expand_cyclestr('log.@y@j.@H@M @a @b', cycles).tolist() == [
+        'log.23365.1200 Sun Dec', 'log.23365.1800 Sun Dec',
+        'log.24001.0000 Mon Jan', 'log.24001.0600 Mon Jan']
+    expanded = expand_cyclestr('@A @B @s', cycles, offset='1:00:00')
+    assert expanded.tolist() == [expand_cyclestr('@A @B @s', c, offset='1:00:00')
+                                 for c in cycles.tolist()]
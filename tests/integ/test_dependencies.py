@@ -0,0 +1,227 @@
+import pytest
+from io import StringIO
+from xml.etree.ElementTree import tostring
+from pyrocoto import (Workflow, Task, Dependency, DataDep, TaskDep, MetaTaskDep,
+                      TimeDep)
+from factories import make_task
+
+
+@pytest.fixture
+def flow():
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.set_log('log.@Y@m@d@H')
+    return flow
+
+
+def test_forward_dependencies_resolved_at_write(flow):
+    flow.add_task(make_task('post', Dependency.operator('and', TaskDep('fcst'),
+                                                        DataDep('/data'))))
+    flow.add_task(make_task('fcst', TaskDep('prep')))
+    with pytest.raises(ValueError, match="'prep' of \\['fcst'\\] is not in workflow"):
+        flow.write_xml(StringIO())
+    flow.add_task(make_task('prep'))
+    flow.write_xml(StringIO())
+
+
+def test_upstream_and_downstream(flow):
+    flow.add_task(make_task('prep'))
+    flow.add_task(make_task('mem#m#', TaskDep('prep'), meta={'m': '1 2'},
+                            metatask_name='ens'))
+    flow.add_task(make_task('post#m#', TaskDep('mem#m#'), meta={'m': '1 2'}))
+    flow.add_task(make_task('final', MetaTaskDep('ens', cycle_offset='-1:00:00')))
+    assert flow.upstream('post2') == {'mem2'}
+    assert flow.upstream('post2', recursive=True) == {'mem2', 'prep'}
+    assert flow.upstream('final') == {'mem1', 'mem2'}
+    assert flow.downstream('mem1') == {'post1', 'final'}
+    assert flow.downstream('prep', recursive=True) == {'mem1', 'mem2', 'post1', 'post2',
+                                                       'final'}
+    with pytest.raises(ValueError, match='not in workflow'):
+        flow.upstream('missing')
+
+
+def test_find_cycles(flow):
+    flow.add_task(make_task('a', TaskDep('c')))
+    flow.add_task(make_task('b', TaskDep('a')))
+    flow.add_task(make_task('c', TaskDep('b')))
+    flow.add_task(make_task('d', TaskDep('d', cycle_offset='-1:00:00')))
+    flow.add_task(make_task('e', TaskDep('e', cycle_offset='00:00')))
+    assert flow.find_cycles() == [['a', 'b', 'c'], ['e']]
+    with pytest.raises(ValueError, match='a <-> b <-> c'):
+        flow.write_xml(StringIO())
+
+
+def test_find_cycles_with_offsets(flow):
+    # offsets adding up to zero lead back to the same cycle
+    flow.add_task(make_task('a', TaskDep('b', cycle_offset='01:00:00')))
+    flow.add_task(make_task('b', TaskDep('a', cycle_offset='-01:00:00')))
+    # as do offsets of cycles that are combined, +2h - 1h - 1h
+    flow.add_task(make_task('c', Dependency.operator('and', TaskDep('d', '02:00:00'),
+                                                     TaskDep('c', '-1:00:00'))))
+    flow.add_task(make_task('d', TaskDep('c')))
+    # but not offsets all going back in time
+    flow.add_task(make_task('e', TaskDep('f', cycle_offset='-01:00:00')))
+    flow.add_task(make_task('f', Dependency.operator('and', TaskDep('e'),
+                                                     TaskDep('f', '-1:00:00'))))
+    assert flow.find_cycles() == [['a', 'b'], ['c', 'd']]
+    assert flow.validate() == ['Task dependency cycle found: a <-> b',
+                               'Task dependency cycle found: c <-> d']
+    with pytest.raises(ValueError, match='a <-> b'):
+        flow.write_xml(StringIO())
+
+
+def test_topological_order(flow):
+    flow.add_task(make_task('post', Dependency.operator('and', TaskDep('fcst1'),
+                                                        TaskDep('fcst2', cycle_offset='0:00'))))
+    flow.add_task(make_task('fcst#m#', Dependency.operator('or', TaskDep('prep'),
+                                                           TaskDep('post', '-1:00:00')),
+                            meta={'m': '1 2'}))
+    flow.add_task(make_task('prep'))
+    assert flow.find_cycles() == []
+    assert flow.topological_order() == ['prep', 'fcst1', 'fcst2', 'post']
+    f = StringIO()
+    flow.write_xml(f, ordered=True)
+    names = [line.split('"')[1] for line in f.getvalue().splitlines() if '<task ' in line]
+    assert names == ['prep', 'fcst#m#', 'post']
+
+
+def test_reduce_dependencies(flow):
+    flow.add_task(make_task('a'))
+    flow.add_task(make_task('b', TaskDep('a')))
+    flow.add_task(make_task('c', Dependency.operator('and', TaskDep('b'), TaskDep('a'))))
+    flow.add_task(make_task('d', Dependency.operator('and', TaskDep('a'), DataDep('/data'),
+                                                     TaskDep('c'), TaskDep('b'))))
+    flow.add_task(make_task('e', Dependency.operator('and', TaskDep('b'),
+                                                     TaskDep('a', state='failed'))))
+    flow.add_task(make_task('f', Dependency.operator('or', TaskDep('b'), TaskDep('a'))))
+    flow.add_task(make_task('m#x#', Dependency.operator('and', TaskDep('#x#'), TaskDep('a')),
+                            meta={'x': 'b c'}))
+    assert flow.reduce_dependencies() == 4
+    assert flow.tasks[2].dependency.elm.attrib == {'task': 'b'}
+    d = flow.tasks[3].dependency.elm
+    assert [E.tag for E in d] == ['datadep', 'taskdep']
+    assert d[1].attrib == {'task': 'c'}
+    assert len(flow.tasks[4].dependency.elm) == 2
+    assert len(flow.tasks[5].dependency.elm) == 2
+    assert flow.tasks[6].dependency.elm.attrib == {'task': '#x#'}
+    assert flow.upstream('d') == {'c'}
+    assert flow.downstream('a') == {'b', 'e', 'f'}
+
+
+def test_simplify_dependency():
+    from xml.etree.ElementTree import Element
+    a = TaskDep('a')
+    inner = Dependency.operator('and', a, TaskDep('b'))
+    dep = Dependency.operator('and', inner, DataDep('/data'), DataDep('/data'), TaskDep('a'))
+    assert tostring(dep.simplify().elm) == (b'<and><taskdep task="a" /><taskdep task="b" />'
+                                            b'<datadep>/data</datadep></and>')
+    nested_not = Element('not')
+    nested_not.append(Element('not'))
+    leaf = a.elm
+    nested_not[0].append(leaf)
+    single = Element('or')
+    single.append(nested_not)
+    assert Dependency(single).simplify().elm is leaf
+    E = Dependency(single).to_element()
+    assert tostring(E) == b'<dependency><taskdep task="a" /></dependency>'
+    xor = Dependency.operator('xor', a, TaskDep('a'))
+    assert xor.simplify() is xor
+    assert a.simplify() is a
+
+
+def test_dependency_elements_made_when_needed():
+    a, b = TaskDep('a'), DataDep('/data')
+    dep = Dependency.operator('and', a, Dependency.operator('or', b, TimeDep('@H')))
+    assert dep.refs == (('taskdep', 'a', None),)
+    assert a._element is None and dep._element is None  # made when written
+    assert dep.elm[0] is a.elm and dep.elm[1][0] is b.elm
+    # changes to the element of a dependency are kept
+    a.elm.set('state', 'RUNNING')
+    assert TaskDep('a').elm.get('state') is None
+    assert tostring(dep.to_element()) == (b'<dependency><and><taskdep task="a" state="RUNNING" />'
+                                          b'<or><datadep>/data</datadep><timedep><cyclestr>@H'
+                                          b'</cyclestr></timedep></or></and></dependency>')
+
+
+def test_add_tasks_batch(flow):
+    flow.add_task(make_task('prep'))
+    flow.add_tasks(make_task(f'post_{i}', TaskDep('prep')) for i in range(3))
+    assert [task.name for task in flow.tasks] == ['prep', 'post_0', 'post_1', 'post_2']
+    assert flow.downstream('prep') == {'post_0', 'post_1', 'post_2'}
+
+    bad = [make_task('fcst'),
+           make_task('prep'),
+           make_task('fcst'),
+           make_task('late', cycledefs='daily'),
+           Task({'name': 'incomplete', 'cycledefs': 'hourly'})]
+    with pytest.raises(ValueError) as excinfo:
+        flow.add_tasks(iter(bad))
+    assert str(excinfo.value).splitlines() == [
+        '8 errors adding tasks:',
+        "Task names must be unique; Error adding task 'prep'",
+        "Task names must be unique; Error adding task 'fcst'",
+        'task \'late\': cycle definition "daily" not in workflow',
+        "task 'incomplete': Expected one of ['command'] to be set",
+        "task 'incomplete': Expected one of ['join', 'stderr'] to be set",
+        "task 'incomplete': Expected one of ['cores', 'nodes'] to be set",
+        "task 'incomplete': Expected one of ['queue'] to be set",
+        "task 'incomplete': Expected one of ['account'] to be set"]
+    # nothing from the failed batch was added
+    assert len(flow.tasks) == 4
+    assert flow.task_names == {'prep', 'post_0', 'post_1', 'post_2'}
+    flow.add_task(make_task('fcst'))
+
+    with pytest.raises(ValueError, match="task #1: Expected a Task, but got <class 'NoneType'>"):
+        flow.add_tasks([make_task('good'), None])
+
+    class Broken(Task):
+        def _validation_errors(self):
+            raise RuntimeError('broken')
+    with pytest.raises(RuntimeError, match='broken'):
+        flow.add_tasks([make_task('good'), Broken({'name': 'broken'})])
+    # the names of a batch that raised are released too
+    assert flow.task_names == {'prep', 'post_0', 'post_1', 'post_2', 'fcst'}
+    flow.add_task(make_task('good'))
+
+
+def test_equal_envars_and_leaves_share_specs():
+    envar = {'COMOUT': '/com/gfs.@Y@m@d', 'HOMEgfs': '/save/gfs'}
+    a = make_task('a', DataDep('/com/@Y@m@d/a.nc'), envar=dict(envar))
+    b = make_task('b', DataDep('/com/@Y@m@d/a.nc'), envar=dict(envar))
+    assert a.envar is b.envar
+    assert a.dependency is not b.dependency
+    assert a.dependency.spec is b.dependency.spec
+    Ea, Eb = a._generate_xml(), b._generate_xml()
+    assert tostring(Ea.find('envar')) == tostring(Eb.find('envar'))
+    # only the specs are shared, the elements of each task are its own
+    Ea.find('envar').find('value').text = 'CHANGED'
+    Ea.find('dependency')[0].text = 'hacked'
+    assert tostring(Eb) == tostring(b._build_xml())
+    assert b'CHANGED' not in tostring(Eb) and b'hacked' not in tostring(Eb)
+    with pytest.raises(TypeError, match="envar 'N' value 1"):
+        make_task('c', envar={'N': 1})
+
+
+def test_deferred_validation():
+    flow = Workflow(_shared=False, defer_validation=True)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.add_task(make_task('b', TaskDep('a')))
+    flow.add_tasks([make_task('a', TaskDep('b')),
+                    make_task('a'),
+                    make_task('c', TaskDep('missing')),
+                    make_task('d', TaskDep('broken')),
+                    make_task('broken', cycledefs='daily')])
+    assert flow.tasks == []
+    errors = ["Task names must be unique; Error adding task 'a'",
+              'task \'broken\': cycle definition "daily" not in workflow',
+              "Task dependency 'missing' of ['c'] is not in workflow",
+              'Task dependency cycle found: a <-> b']
+    assert flow.validate() == errors
+    assert [task.name for task in flow.tasks] == ['b', 'a', 'c', 'd']
+    # tasks with errors wait to be validated again
+    assert flow.validate() == errors
+    with pytest.raises(ValueError) as excinfo:
+        flow.write_xml(StringIO())
+    assert str(excinfo.value).splitlines() == ['4 errors in workflow:'] + errors
+    with pytest.raises(ValueError, match='2 errors adding tasks'):
+        flow.downstream('a')
@@ -0,0 +1,75 @@
+import pytest
+from pyrocoto import Workflow, product_meta
+from factories import make_task
+
+
+def test_product_meta():
+    meta = product_meta({'member': '01 02', 'lead': range(0, 9, 3), 'var': ['t']})
+    assert meta == {'member': '01 01 01 02 02 02',
+                    'lead': '0 3 6 0 3 6',
+                    'var': 't t t t t t'}
+
+
+def test_metatask_names():
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    task = make_task('post_#member#_f#lead#_{x}', meta=product_meta({'member': '01 02',
+                                                                    'lead': '000 003'}))
+    assert task.task_names == {'post_01_f000_{x}', 'post_01_f003_{x}',
+                               'post_02_f000_{x}', 'post_02_f003_{x}'}
+    flow.add_task(task)
+    assert flow.task_names == task.task_names
+
+    with pytest.raises(ValueError, match='meta variables must produce unique tasks'):
+        flow.add_task(make_task('fcst_#member#', meta={'member': '01 02 01'}))
+    assert flow.task_names == task.task_names
+    with pytest.raises(ValueError, match='meta vars not all equal length'):
+        flow.add_task(make_task('fcst_#member#', meta={'member': '01 02', 'lead': '000'}))
+
+
+def test_nested_metatask():
+    from io import StringIO
+    from pyrocoto import MetaTaskDep
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.set_log('log')
+    members = {'member': '01 02'}
+    leads = {'lead': '000 003 006', 'hour': '0 3 6'}
+    nested = make_task('post_#member#_f#lead#', meta=[members, leads], metatask_name='post')
+    flat = make_task('post_#member#_f#lead#',
+                     meta=product_meta({**members, 'lead': leads['lead']}))
+    assert nested.task_names == flat.task_names
+    flow.add_task(nested)
+    flow.add_task(make_task('final', meta={'x': 'y'}, dependency=MetaTaskDep('post')))
+    assert flow.upstream('final') == flat.task_names
+
+    f = StringIO()
+    flow.write_xml(f)
+    assert '''\
+    <metatask name="post">
+        <var name="member">01 02</var>
+        <metatask>
+            <var name="lead">000 003 006</var>
+            <var name="hour">0 3 6</var>
+            <task name="post_#member#_f#lead#" cycledefs="hourly" maxtries="2">''' in f.getvalue()
+
+    with pytest.raises(ValueError, match='repeated in nested metatask'):
+        make_task('post_#member#', meta=[members, members])
+
+
+def test_unique_metatask_names():
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.add_task(make_task('post_#m#', meta={'m': '1 2'}, metatask_name='post'))
+    error = "Metatask names must be unique; Error adding task 'ens_#m#' with metatask name 'post'"
+    with pytest.raises(ValueError, match=error):
+        flow.add_task(make_task('ens_#m#', meta={'m': '1 2'}, metatask_name='post'))
+    assert flow.metatask_names == {'post'} and len(flow.tasks) == 1
+
+    deferred = Workflow(_shared=False, defer_validation=True)
+    deferred.define_cycle('hourly', '0 * * * * *')
+    deferred.add_tasks([make_task('a_#m#', meta={'m': '1 2'}, metatask_name='ens'),
+                        make_task('b_#m#', meta={'m': '1 2'}, metatask_name='ens')])
+    assert deferred.validate() == [
+        "Metatask names must be unique; Error adding task 'b_#m#' with metatask name 'ens'"]
+    assert [task.name for task in deferred.tasks] == ['a_#m#']
@@ -0,0 +1,69 @@
+import os
+import pytest
+from io import BytesIO, StringIO
+from xml.etree.ElementTree import tostring
+from pyrocoto import read_xml, Offset, TaskDep, DataDep, TimeDep
+
+integ_dir = os.path.dirname(__file__)
+
+
+def xml(flow):
+    f = StringIO()
+    flow.write_xml(f)
+    return f.getvalue()
+
+
+@pytest.mark.parametrize('path', ['test_basic/minimal_workflow.validate',
+                                  'test_basic/task2_workflow.validate',
+                                  'test_custom_tasks/mytasks_workflow.validate'])
+def test_read_xml_round_trip(path):
+    path = os.path.join(integ_dir, path)
+    with open(path) as f:
+        assert xml(read_xml(path)) == f.read()
+
+
+def test_read_legacy_xml():
+    flow = read_xml(os.path.join(integ_dir, 'test_read_xml', 'legacy_workflow.xml'))
+    assert flow.workflow_element.attrib == {'realtime': 'F', 'scheduler': 'slurm',
+                                            'cyclethrottle': '2'}
+    assert flow.cycle_definitions['hourly'].activation_offset == '-01:00:00'
+    prep, post = flow.tasks
+    # entities, including SYSTEM entities, are resolved
+    assert prep.account == 'GFS-DEV'
+    assert prep.envar == (('HOMEgfs', '/save/gfs', None), ('MORE', 'yes', None))
+    assert prep.cycledefs == ['gfs', 'hourly']  # all cycle definitions
+    assert prep.command == '/save/gfs/jobs/prep @Y@m@d@H'
+    assert isinstance(prep.join, Offset) and prep.join.offset == '-06:00:00'
+    and_ = prep.dependency.elm
+    assert [E.tag for E in and_] == ['datadep', 'timedep', 'not', 'taskdep']
+    assert tostring(and_[0]) == tostring(DataDep('/dcom/@Y@m@d/obs', age='120',
+                                                 minsize='1').elm)
+    assert tostring(and_[1]) == tostring(TimeDep(Offset('@Y@m@d@H@M@S', '01:00:00')).elm)
+    assert tostring(and_[3]) == tostring(TaskDep('post_001_000', cycle_offset='-06:00:00').elm)
+    assert prep.dependency.refs == (('taskdep', 'post_001_000', '-06:00:00'),)
+    assert post.meta == [{'mem': '001 002'}, {'fhr': '000 006'}]
+    assert post.metatask_name == 'post'
+    assert 'post_002_006' in flow.task_names
+
+    # the written workflow loads to the same workflow
+    text = xml(flow)
+    assert xml(read_xml(BytesIO(text.encode()))) == text
+
+
+def test_read_xml_errors():
+    text = b'''<?xml version="1.0"?>
+<workflow realtime="T" scheduler="lsf">
+  <cycledef group="hourly">0 * * * * *</cycledef>
+  <task name="a" throttle="2"><command>/a</command></task>
+  <task name="b"><command>/b @Y <cyclestr>@m</cyclestr></command></task>
+  <metatask name="m"><var name="x">1 2</var><task name="c#x#"/><task name="d#x#"/></metatask>
+  <task name="e"><command>/e</command></task>
+</workflow>
+'''
+    with pytest.raises(ValueError) as excinfo:
+        read_xml(BytesIO(text))
+    assert str(excinfo.value).splitlines()[1:] == [
+        "<task name='a'>: task attributes ['throttle'] is not supported; in 'a'",
+        "<task name='b'>: '@' outside of cyclestr in <command> is not supported; in 'b'",
+        "<metatask name='m'>: metatask not holding exactly one task or metatask is not "
+        "supported; in 'm'"]
@@ -0,0 +1,86 @@
+import pytest
+from xml.etree.ElementTree import Element, SubElement
+from pyrocoto import Workflow, TaskDep, MetaTaskDep, Dependency, read_xml
+from factories import make_task
+
+
+@pytest.fixture
+def flow():
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.define_cycle('daily', '0 0 * * * *')
+    flow.set_log('/logs/gfs.@Y@m@d@H')
+    flow.add_tasks([make_task('prep'),
+                    make_task('fcst', TaskDep('prep')),
+                    make_task('post_#lead#', TaskDep('fcst'), metatask_name='post',
+                              meta={'lead': '000 003'}),
+                    make_task('arch', Dependency.operator('and', MetaTaskDep('post'),
+                                                          TaskDep('fcst', '-24:00:00')),
+                              cycledefs='daily'),
+                    make_task('verify', TaskDep('verify_prep')),
+                    make_task('verify_prep')])
+    return flow
+
+
+def test_partition_components(flow):
+    shards = flow.partition()
+    assert {key: [task.name for task in shard.tasks]
+            for key, shard in shards.workflows.items()} == {
+        'component0': ['prep', 'fcst', 'post_#lead#', 'arch'],
+        'component1': ['verify', 'verify_prep']}
+    assert shards.cross_dependencies == []
+    assert shards.workflows['component1'].cycle_definitions == {
+        'hourly': flow.cycle_definitions['hourly']}
+
+
+def test_partition_cycledef(flow, tmpdir):
+    shards = flow.partition(by='cycledef', sentinel_dir='/sentinels')
+    assert shards.cross_dependencies == [
+        ('arch', 'daily', 'metataskdep', 'post', None, ['hourly'],
+         '/sentinels/post_metatask.@Y@m@d@H@M'),
+        ('arch', 'daily', 'taskdep', 'fcst', '-24:00:00', ['hourly'],
+         '/sentinels/fcst_task.@Y@m@d@H@M')]
+    hourly, daily = shards.workflows['hourly'], shards.workflows['daily']
+    assert ({'post_metatask_sentinel', 'fcst_task_sentinel'} <=
+            {task.name for task in hourly.tasks})
+    assert daily.upstream('arch') == set()
+    # the workflow is not changed
+    assert flow.upstream('arch') == {'post_000', 'post_003', 'fcst'}
+
+    paths = shards.write(str(tmpdir))
+    assert paths['daily'] == (str(tmpdir.join('daily.xml')), str(tmpdir.join('daily.db')))
+    xml = tmpdir.join('daily.xml').read()
+    assert '<cyclestr offset="-24:00:00">/sentinels/fcst_task.@Y@m@d@H@M</cyclestr>' in xml
+    assert '<cyclestr>/logs/daily/gfs.@Y@m@d@H</cyclestr>' in xml
+    assert 'touch /sentinels/post_metatask.@Y@m@d@H@M' in tmpdir.join('hourly.xml').read()
+    assert len(read_xml(paths['hourly'][0]).tasks) == 7
+
+
+def test_partition_by_key(flow):
+    shards = flow.partition(by=lambda task: 'verify' if 'verify' in task.name else 'main',
+                            log='/logs/{shard}.@Y@m@d@H')
+    assert list(shards.workflows) == ['main', 'verify']
+    assert shards.workflows['verify'].log_element[0].text == '/logs/verify.@Y@m@d@H'
+    with pytest.raises(TypeError, match="shard key of task 'prep'"):
+        flow.partition(by=lambda task: None)
+    # a log of text and cyclestr has no directory of its own to put the shards in
+    flow.log_element = Element('log')
+    flow.log_element.text = '/logs/'
+    SubElement(flow.log_element, 'cyclestr').text = 'gfs.@Y@m@d@H'
+    with pytest.raises(ValueError, match=r"pass partition log='\.\.\.\{shard\}\.\.\.'"):
+        flow.partition()
+    assert list(flow.partition(log='/logs/{shard}.log').workflows) == ['component0',
+                                                                       'component1']
+
+
+def test_partition_sentinel_names(flow):
+    # a metatask and a task of the same name have their own sentinels
+    flow.add_task(make_task('post', MetaTaskDep('post'), cycledefs='daily'))
+    flow.add_task(make_task('archpost', TaskDep('post'), cycledefs='hourly'))
+    shards = flow.partition(by='cycledef')
+    assert 'post_metatask_sentinel' in shards.workflows['hourly'].task_names
+    assert 'post_task_sentinel' in shards.workflows['daily'].task_names
+    flow.add_task(make_task('fcst_task_sentinel'))
+    with pytest.raises(ValueError, match="Sentinel task 'fcst_task_sentinel' of the taskdep "
+                                         "on 'fcst' clashes"):
+        flow.partition(by='cycledef')
@@ -0,0 +1,39 @@
+import pytest
+from datetime import datetime
+from functools import partial
+from pyrocoto import Workflow, Dependency, TaskDep, MetaTaskDep, simulate
+from factories import make_task
+
+pytest.importorskip('numpy')
+
+make_task = partial(make_task, queue='serial', walltime='00:20:00')
+
+
+def test_simulate_workflow():
+    flow = Workflow(_shared=False, realtime='T', cyclethrottle='2', taskthrottle='3')
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.add_task(make_task('prep'))
+    flow.add_task(make_task('fcst#m#', meta={'m': '1 2 3'}, metatask_name='ens',
+                            nodes='2:ppn=8', queue='parallel', dependency=TaskDep('prep')))
+    flow.add_task(make_task('post', walltime='00:50:00', dependency=Dependency.operator(
+        'and', MetaTaskDep('ens'), TaskDep('post', cycle_offset='-1:00:00'))))
+
+    report = simulate(flow, '202401010000', '202401010200')
+    assert report.jobs == 15
+    assert report.peak_jobs == 3
+    assert report.peak_cores == {'serial': 2, 'parallel': 48}
+    # from the second cycle on, post of the previous cycle takes a taskthrottle slot
+    # so one ensemble member waits 10 minutes
+    assert report.cycle_latency == {datetime(2024, 1, 1, 0): 5400,
+                                    datetime(2024, 1, 1, 1): 6000,
+                                    datetime(2024, 1, 1, 2): 6600}
+
+
+def test_simulate_cyclelifespan():
+    flow = Workflow(_shared=False, realtime='F', cyclelifespan='00:30:00')
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.add_task(make_task('a', walltime='00:40:00'))
+    flow.add_task(make_task('b', dependency=TaskDep('a')))
+    report = simulate(flow, '202401010000', '202401010100')
+    assert report.expired == [datetime(2024, 1, 1, 0), datetime(2024, 1, 1, 1)]
+    assert report.blocked == {datetime(2024, 1, 1, 0): ['b'], datetime(2024, 1, 1, 1): ['b']}
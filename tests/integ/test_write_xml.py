@@ -0,0 +1,180 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+from xml.dom import minidom
+from xml.etree.ElementTree import Element, SubElement, fromstring, tostring
+from pyrocoto import Workflow, Task
+
+
+def minidom_prettify(elem):
+    reparsed = minidom.parseString(tostring(elem, 'UTF-8'))
+    return reparsed.toprettyxml(indent="    ", encoding=None)
+
+
+def test_prettify_matches_minidom():
+    E = Element('workflow', realtime='T', note='a "quoted" <value> & more')
+    E.text = 'leading text'
+    log = SubElement(E, 'log')
+    SubElement(log, 'cyclestr').text = 'log.@Y@m@d@H'
+    log.tail = 'tail & text\r\n'
+    SubElement(E, 'empty')
+    SubElement(E, 'blank').text = ''
+    SubElement(E, 'spaces').text = '   '
+    assert Workflow.prettify(E) == minidom_prettify(E)
+
+
+def test_write_xml_to_file_object():
+    flow = Workflow(_shared=False)
+    hourly = flow.define_cycle('hourly', '0 * * * * *')
+
+    @flow.task()
+    def task1():
+        name = 'task1'
+        cycledefs = hourly
+        command = '/runcommand @Y@m@d@H'
+        cores = '1'
+        join = '/task1_@Y@m@d@H.join'
+        queue = 'queue'
+        account = 'my_account'
+        return Task(locals())
+
+    flow.set_log('log_task1.@Y@m@d@H')
+    f = StringIO()
+    flow.write_xml(f)
+    expected = ('<?xml version="1.0"?>\n<!DOCTYPE workflow []>' +
+                minidom_prettify(flow._generate_xml())[22:])
+    assert f.getvalue() == expected
+
+    # writing does not modify the workflow, repeated writes are identical
+    f2 = StringIO()
+    flow.write_xml(f2)
+    assert f2.getvalue() == expected
+    assert len(flow.workflow_element) == 0
+
+
+def test_task_xml_cache_invalidated_on_change():
+    task = Task({'name': 'task1', 'cycledefs': 'hourly', 'command': '/runcommand',
+                 'cores': '1', 'join': '/task1.join', 'queue': 'queue', 'account': 'acct'})
+    E = task._generate_xml()
+    assert task._generate_xml() is E
+    task.command = '/other_command @Y@m@d@H'
+    E2 = task._generate_xml()
+    assert E2 is not E
+    assert '<cyclestr>/other_command @Y@m@d@H</cyclestr>' in task._xml()
+    task.nodes = '2:ppn=4'
+    assert '<nodes>2:ppn=4</nodes>' in task._xml()
+
+
+def test_write_xml_processes(tmpdir, monkeypatch):
+    import pyrocoto.pyrocoto as module
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.set_log('/ptmp/logs/@Y@m@d@H/workflow.log')
+    for i in range(20):
+        flow.add_task(Task({'name': f'post{i}_#lead#', 'metatask_name': f'post{i}',
+                            'meta': {'lead': '000 003'}, 'cycledefs': 'hourly',
+                            'command': f'/post {i} #lead# @Y@m@d@H', 'cores': '1',
+                            'join': f'/ptmp/logs/@Y@m@d@H/post{i}.join', 'queue': 'queue',
+                            'account': 'acct', 'envar': {'LEAD': '#lead#'}}))
+    serial, entities = StringIO(), StringIO()
+    flow.write_xml(serial)
+    flow.write_xml(entities, entities=True)
+    for task in flow.tasks:
+        task._xml_cache = None
+    flow.tasks[5]._xml()  # cached xml is written by the parent
+
+    started = []
+
+    class Pool(ProcessPoolExecutor):
+        def __init__(self, max_workers, mp_context):
+            # the pool is not forked and the workflow is free while it runs
+            started.append(mp_context.get_start_method())
+
+            def probe():
+                started.append(flow._lock.acquire(False))
+                if started[-1]:
+                    flow._lock.release()
+            probe = threading.Thread(target=probe)
+            probe.start()
+            probe.join()
+            super().__init__(max_workers, mp_context=mp_context)
+    monkeypatch.setattr(module, 'ProcessPoolExecutor', Pool)
+    f = StringIO()
+    flow.write_xml(f, processes=3)
+    assert f.getvalue() == serial.getvalue()
+    assert started[0] in ('forkserver', 'spawn') and started[1] is True
+    assert flow.tasks[4]._xml_cache is None  # generated by the pool
+    f = StringIO()
+    flow.write_xml(f, entities=True, processes=2)
+    assert f.getvalue() == entities.getvalue()
+
+    xmlfile = str(tmpdir.join('flow.xml'))
+    assert flow.write_xml(xmlfile, incremental=True, processes=2)['written']
+    assert tmpdir.join('flow.xml').read() == serial.getvalue()
+    flow.tasks[7].command = '/changed'
+    diff = flow.write_xml(xmlfile, incremental=True, processes=2)
+    assert diff['changed'] == {'post7_#lead#': ['command']}
+    serial = StringIO()
+    flow.write_xml(serial)
+    assert tmpdir.join('flow.xml').read() == serial.getvalue()
+
+
+def test_write_xml_entities():
+    flow = Workflow(_shared=False)
+    flow.define_cycle('hourly', '0 * * * * *')
+    flow.set_log('/ptmp/logs/@Y@m@d@H/workflow.log')
+    for i in range(3):
+        flow.add_task(Task({'name': f'post{i}', 'cycledefs': 'hourly', 'cores': '1',
+                            'command': f'/save/gfs/jobs/JPOST {i}',
+                            'join': f'/ptmp/logs/@Y@m@d@H/post{i}.log',
+                            'queue': 'dev_shared', 'account': 'acct',
+                            'native': '-R "span[ptile=1]" && 50%',
+                            'envar': {'COMOUT': '/com/gfs.@Y@m@d/@H'}}))
+    plain, f = StringIO(), StringIO()
+    flow.write_xml(plain)
+    flow.write_xml(f, entities=True)
+    xml = f.getvalue()
+    assert xml.startswith('<?xml version="1.0"?>\n<!DOCTYPE workflow [\n'
+                          '    <!ENTITY COMOUT "/com/gfs.@Y@m@d/@H">\n'
+                          '    <!ENTITY JOBS_DIR "/save/gfs/jobs/">\n'
+                          '    <!ENTITY LOGS_DIR "/ptmp/logs/@Y@m@d@H/">\n'
+                          '    <!ENTITY NATIVE '
+                          '"-R &quot;span[ptile=1]&quot; &amp;&amp; 50&#37;">\n'
+                          '    <!ENTITY QUEUE "dev_shared">\n'
+                          ']>\n')
+    assert '<cyclestr>&LOGS_DIR;workflow.log</cyclestr>' in xml
+    assert '<command>&JOBS_DIR;JPOST 1</command>' in xml
+    # entities are expanded by the parser
+    assert (tostring(fromstring(xml.encode())) ==
+            tostring(fromstring(plain.getvalue().encode())))
+
+
+def test_write_xml_incremental(tmpdir):
+    def make(command, names=('a', 'b', 'c'), log='log.@Y'):
+        flow = Workflow(_shared=False)
+        flow.define_cycle('hourly', '0 * * * * *')
+        flow.set_log(log)
+        for name in names:
+            flow.add_task(Task({'name': name, 'cycledefs': 'hourly', 'cores': '1',
+                                'command': command if name == 'b' else f'/{name}',
+                                'join': '/j', 'queue': 'q', 'account': 'a'}))
+        return flow
+
+    xmlfile = str(tmpdir.join('flow.xml'))
+    diff = make('/b').write_xml(xmlfile, incremental=True)
+    assert diff['added'] == ['a', 'b', 'c'] and diff['written']
+    mtime = os.stat(xmlfile).st_mtime_ns
+    diff = make('/b').write_xml(xmlfile, incremental=True)
+    assert not diff['written'] and not diff['added'] and not diff['changed']
+    assert os.stat(xmlfile).st_mtime_ns == mtime
+
+    flow = make('/b2', names=('a', 'b'))
+    assert flow.diff(xmlfile)['changed'] == {'b': ['command']}
+    diff = flow.write_xml(xmlfile, incremental=True)
+    assert diff['changed'] == {'b': ['command']} and diff['removed'] == ['c']
+    f = StringIO()
+    flow.write_xml(f)
+    with open(xmlfile) as written:
+        assert written.read() == f.getvalue()
+    assert make('/b2', names=('a', 'b'), log='other').diff(xmlfile)['workflow'] == ['log']